@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks for the per-packet host overhead: FourBySix, packet
+parsing and assembly, CRC8, hexify and SubgRfspyLink.handle_response.
+
+Runs offline over the frames in pump_frames.txt, and reports the time per
+operation and the number of objects each operation leaves allocated. Python
+2 has no tracemalloc, so the latter comes from the garbage collector's
+allocation counter: it only sees container objects (lists, dicts, instances
+and so on), not strings or bytearrays, and objects released before the call
+returns cancel out.
+
+  python benchmarks/bench_codec.py [--filter substring] [--min-time seconds]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from decocare.lib import CRC8
+
+from mmeowlink.fourbysix import FourBySix, FourBySixDecoder
+from mmeowlink.hex_handling import hexify
+from mmeowlink.packets.rf import Packet, LazyPacket, FrameTemplate
+from mmeowlink.vendors.subg_rfspy_link import SubgRfspyLink
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pump_frames.txt')
+
+def load_corpus (path=CORPUS):
+  frames = [ ]
+  for line in open(path):
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    name, hex_frame = line.split()
+    frames.append((name, bytearray(hex_frame.decode('hex'))))
+  return frames
+
+def _count_allocations (func, loops):
+  # With the collector disabled, the generation 0 count goes up with every
+  # container allocation and down with every release. Collecting before
+  # each call resets it to zero.
+  gc.disable()
+  try:
+    allocated = 0
+    for _ in range(loops):
+      gc.collect()
+      start = gc.get_count()[0]
+      func()
+      allocated += max(gc.get_count()[0] - start, 0)
+    return float(allocated) / loops
+  finally:
+    gc.enable()
+
+def count_allocations (func, loops):
+  # Take off what the measurement itself costs
+  return _count_allocations(func, loops) - _count_allocations(lambda: None, loops)
+
+def measure (func, min_time):
+  loops = 1
+  while True:
+    elapsed = timeit.Timer(func).timeit(number=loops)
+    if elapsed >= min_time / 5:
+      break
+    loops *= 4
+  best = min(timeit.Timer(func).repeat(repeat=5, number=loops))
+  return best / loops * 1e9, count_allocations(func, min(loops, 100))
+
+def build_cases (frames):
+  link = SubgRfspyLink.__new__(SubgRfspyLink)
+  cases = [ ]
+  for name, frame in frames:
+    encoded = FourBySix.encode(frame)
+    # As it comes off the serial port: RSSI, sequence, then the radio packet
+    response = bytearray([0x40, 0x01]) + encoded[:-1]
+    serial = str(frame[1:4]).encode('hex')
+    op = frame[4]
+    payload = frame[5:-1]
+    template = FrameTemplate.get(serial, op)
+    packet = Packet.fromBuffer(frame).as_packet()
+
+    def stream_decode (encoded=encoded):
+      decoder = FourBySixDecoder()
+      for i in range(0, len(encoded), 16):
+        decoder.feed(encoded[i:i + 16])
+      return decoder.finish()
+
+    cases.extend([
+      ('fourbysix.encode', name, lambda frame=frame: FourBySix.encode(frame)),
+      ('fourbysix.decode', name, lambda encoded=encoded: FourBySix.decode(encoded)),
+      ('fourbysix.stream_decode', name, stream_decode),
+      ('packet.fromBuffer', name, lambda frame=frame: Packet.fromBuffer(frame)),
+      ('lazy_packet.fromBuffer', name, lambda frame=frame: LazyPacket.fromBuffer(frame)),
+      ('lazy_packet.as_packet', name, lambda frame=frame: LazyPacket.fromBuffer(frame).as_packet()),
+      ('packet.assemble', name, packet.assemble),
+      ('frame_template.assemble', name, lambda template=template, payload=payload: template.assemble(payload)),
+      ('crc8', name, lambda frame=frame: CRC8.compute(frame)),
+      ('hexify', name, lambda frame=frame: hexify(frame)),
+      ('handle_response', name, lambda response=response: link.handle_response(response)),
+    ])
+  return cases
+
+def main ():
+  parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  parser.add_argument('--filter', default='', help="Only run benchmarks whose name contains this")
+  parser.add_argument('--min-time', default=0.2, type=float, help="Rough time to spend on each benchmark, in seconds")
+  args = parser.parse_args()
+
+  frames = load_corpus()
+  print "%-26s %-16s %12s %10s" % ('benchmark', 'frame', 'ns/op', 'allocs/op')
+  for bench, frame_name, func in build_cases(frames):
+    if args.filter not in bench:
+      continue
+    ns, allocs = measure(func, args.min_time)
+    print "%-26s %-16s %12.0f %10.1f" % (bench, frame_name, ns, allocs)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+End to end timings against the emulated radio and pump in
+mmeowlink.emulator, so link and protocol changes can be measured without
+hardware.
+
+Each benchmark runs a number of times over a SubgRfspyLink talking to a
+SubgRfspyEmulator on a pseudo-terminal, and reports the wall clock time
+per run along with the serial commands and radio packets it took. The
+rfdump benchmark times the get_packet loop RfDumpApp.main runs, over
+packets put on the air by the emulator.
+
+  python benchmarks/bench_link.py [--filter name] [--runs n] [--slow]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from decocare import commands
+
+from mmeowlink.emulator import PumpEmulator, SubgRfspyEmulator
+from mmeowlink.handlers.stick import Pump
+from mmeowlink.mmtune import MMTune
+from mmeowlink.vendors.subg_rfspy_link import SubgRfspyLink
+
+SERIAL = '208850'
+RFDUMP_PACKETS = 20
+
+# Pump.execute reports failure by returning None, which run only counts
+# as a failure if it's raised
+def expect (result, what):
+  if result is None:
+    raise RuntimeError("%s failed" % what)
+  return result
+
+# Closing and opening again, which syncs with the firmware and checks its version
+def bench_reopen (emulator, link):
+  link.close()
+  link.open()
+
+def bench_model (emulator, link):
+  expect(Pump(link, SERIAL).execute(commands.ReadPumpModel()), 'ReadPumpModel')
+
+# The reads a loop makes every cycle
+def loop_reads ( ):
+  return [ commands.ReadPumpModel(), commands.ReadRTC(), commands.ReadBatteryStatus(),
+           commands.ReadRemainingInsulin(), commands.ReadPumpStatus(), commands.ReadBasalTemp(),
+           commands.ReadSettings() ]
+
+def bench_reads (emulator, link):
+  pump = Pump(link, SERIAL)
+  for command in loop_reads():
+    expect(pump.execute(command), command.__class__.__name__)
+
+def bench_reads_many (emulator, link):
+  reads = loop_reads()
+  for command, result in zip(reads, Pump(link, SERIAL).execute_many(reads)):
+    expect(result, command.__class__.__name__)
+
+# The same reads of a pump that's gone out of range, which all fail
+def unreachable (emulator, run_reads):
+  emulator.pump.awake_until = 0
+  try:
+    run_reads()
+  finally:
+    emulator.pump.awake_until = time.time() + emulator.pump.awake_seconds
+
+def bench_reads_unreachable (emulator, link):
+  pump = Pump(link, SERIAL)
+  unreachable(emulator, lambda: [ pump.execute(command) for command in loop_reads() ])
+
+def bench_reads_many_unreachable (emulator, link):
+  pump = Pump(link, SERIAL)
+  unreachable(emulator, lambda: list(pump.execute_many(loop_reads())))
+
+def bench_history (emulator, link):
+  expect(Pump(link, SERIAL).execute(commands.ReadHistoryData(page=0)), 'ReadHistoryData')
+
+def bench_stream_history (emulator, link):
+  for frame in Pump(link, SERIAL).stream_history(0):
+    pass
+
+def bench_mmtune (emulator, link):
+  MMTune(link, SERIAL, 'US').run()
+
+def bench_rfdump (emulator, link):
+  frame = emulator.pump.frame(0x8d, bytearray([0x09]))
+  for _ in range(RFDUMP_PACKETS):
+    emulator.inject(frame)
+  for _ in range(RFDUMP_PACKETS):
+    link.get_packet(timeout=1)
+
+def bench_wakeup (emulator, link):
+  emulator.pump.awake_until = 0
+  pump = Pump(link, SERIAL)
+  pump.power_control(minutes=10)
+  expect(pump.wake_repetitions, 'wakeup')
+
+BENCHMARKS = [
+  ('reopen', bench_reopen),
+  ('execute.model', bench_model),
+  ('execute.reads', bench_reads),
+  ('execute_many.reads', bench_reads_many),
+  ('execute.history', bench_history),
+  ('stream.history', bench_stream_history),
+  ('mmtune', bench_mmtune),
+  ('rfdump', bench_rfdump),
+]
+
+# Only run with --slow: these take as long as they do with a real pump
+SLOW_BENCHMARKS = [
+  ('wakeup', bench_wakeup),
+  ('execute.unreachable', bench_reads_unreachable),
+  ('execute_many.unreachable', bench_reads_many_unreachable),
+]
+
+def run (name, func, emulator, link, runs):
+  times = [ ]
+  failures = 0
+  commands_before = emulator.commands
+  packets_before = emulator.pump.received
+  for _ in range(runs):
+    start = time.time()
+    try:
+      func(emulator, link)
+    except Exception as e:
+      failures += 1
+      logging.debug("%s failed - %s", name, e)
+    times.append(time.time() - start)
+
+  commands_per_run = float(emulator.commands - commands_before) / runs
+  packets_per_run = float(emulator.pump.received - packets_before) / runs
+  print "%-20s %10.1f %10.1f %10.1f %8.1f %8.1f %8d" % (
+    name, sum(times) / runs * 1000, min(times) * 1000, max(times) * 1000,
+    commands_per_run, packets_per_run, failures)
+
+def main ():
+  parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+  parser.add_argument('--filter', default='', help="Only run benchmarks whose name contains this")
+  parser.add_argument('--runs', default=5, type=int, help="Times to run each benchmark")
+  parser.add_argument('--slow', action='store_true', help="Also run the benchmarks that take real pump time, such as wakeup")
+  parser.add_argument('--reply-latency', default=0.005, type=float, help="Seconds before the pump replies")
+  parser.add_argument('--packet-time', default=0.016, type=float, help="Seconds to send each packet")
+  parser.add_argument('--corruption-rate', default=0, type=float, help="Chance of a bit error in each packet from the pump")
+  parser.add_argument('--drop-rate', default=0, type=float, help="Chance of losing each packet")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.CRITICAL)
+  pump = PumpEmulator(SERIAL, awake=True)
+  emulator = SubgRfspyEmulator(pump, reply_latency=args.reply_latency, packet_time=args.packet_time,
+                               corruption_rate=args.corruption_rate, drop_rate=args.drop_rate)
+  emulator.start()
+  link = SubgRfspyLink(emulator.port)
+
+  benchmarks = BENCHMARKS + (SLOW_BENCHMARKS if args.slow else [ ])
+  print "%-20s %10s %10s %10s %8s %8s %8s" % ('benchmark', 'mean ms', 'min ms', 'max ms', 'cmds', 'packets', 'failed')
+  try:
+    for name, func in benchmarks:
+      if args.filter in name:
+        run(name, func, emulator, link, args.runs)
+  finally:
+    link.close()
+    emulator.stop()
+
+if __name__ == '__main__':
+  main()
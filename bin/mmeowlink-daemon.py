@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+
+from mmeowlink.daemon import main
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,72 @@
+"""
+Where mmeowlink keeps state between runs, and helpers for reading and
+writing it. Files are JSON, under ~/.mmeowlink unless MMEOWLINK_CACHE_DIR
+says otherwise, and are replaced atomically so a reader never sees half a
+file. Updates that read a file and write it back should hold locked( ) so
+that two processes don't lose each other's changes.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import tempfile
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+io  = logging.getLogger( )
+log = io.getChild(__name__)
+
+CACHE_DIR = os.environ.get('MMEOWLINK_CACHE_DIR', os.path.expanduser('~/.mmeowlink'))
+
+def cache_path (name):
+  return os.path.join(CACHE_DIR, name)
+
+def load_json (path, default=None):
+  """
+  Contents of the JSON file at path, or default if it's missing or unreadable
+  """
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError) as e:
+    log.debug("Not using %s - %s", path, e)
+    return default
+
+def _make_dir (path):
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+  return directory
+
+@contextlib.contextmanager
+def locked (path):
+  """
+  Hold an exclusive lock, shared with other processes, for updating path
+  """
+  _make_dir(path)
+  with open(path + '.lock', 'a') as lock:
+    if fcntl is not None:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+def save_json (path, data):
+  """
+  Atomically replace the JSON file at path with data
+  """
+  directory = _make_dir(path)
+  fd, tmp = tempfile.mkstemp(dir=directory or '.', prefix='.' + os.path.basename(path))
+  try:
+    with os.fdopen(fd, 'w') as f:
+      json.dump(data, f)
+    os.rename(tmp, path)
+  except:
+    os.unlink(tmp)
+    raise
@@ -5,6 +5,9 @@ module to send arbitrary pump messages.
 from decocare.helpers import messages as decocare_messages
 from mmeowlink.handlers.stick import Pump
 from mmeowlink.link_builder import LinkBuilder
+from mmeowlink.daemon import RemotePump
+from mmeowlink.wake_state import WakeState
+from mmeowlink.response_cache import ResponseCache
 import argcomplete
 
 class BaseMMeowlinkApp(decocare_messages.SendMsgApp):
@@ -15,19 +18,36 @@ class BaseMMeowlinkApp(decocare_messages.SendMsgApp):
     parser.add_argument('--radio_type', dest='radio_type', default='subg_rfspy', choices=['mmcommander', 'subg_rfspy'])
     parser.add_argument('--mmcommander', dest='radio_type', action='store_const', const='mmcommander')
     parser.add_argument('--subg_rfspy', dest='radio_type', action='store_const', const='subg_rfspy')
+    parser.add_argument('--max-symbol-corrections', dest='max_symbol_corrections', type=int, default=0, help="Try to correct up to this many corrupt symbols in each packet from a subg_rfspy radio, keeping the result only if its CRC checks out")
+
+    return parser
+
+  def configure_daemon_params(self, parser):
+    parser.add_argument('--daemon', dest='daemon', metavar='SOCKET', help="Send pump commands through a running mmeowlink-daemon.py instead of opening the radio")
+
+    return parser
+
+  def configure_cache_params(self, parser):
+    parser.add_argument('--cache-reads', dest='cache_reads', action='store_true', help="Answer reads of settings that hardly ever change, such as the model and basal profiles, from ~/.mmeowlink/responses.json while they're fresh")
 
     return parser
 
   def prelude (self, args):
-    port = args.port
-    builder = LinkBuilder( )
-    if port == 'scan':
-      port = builder.scan( )
-    self.link = link = LinkBuilder().build(args.radio_type, port)
-    link.open()
-    # get link
-    # drain rx buffer
-    self.pump = Pump(self.link, args.serial)
+    if getattr(args, 'daemon', None):
+      self.link = None
+      self.pump = RemotePump(args.serial, path=args.daemon)
+    else:
+      port = args.port
+      builder = LinkBuilder( )
+      if port == 'scan':
+        port = builder.scan(args.radio_type)
+      self.link = link = LinkBuilder().build(args.radio_type, port, max_symbol_corrections=getattr(args, 'max_symbol_corrections', 0))
+      link.open()
+      # get link
+      # drain rx buffer
+      # Remembering wakeups lets --init skip waking a pump that's still awake
+      responses = ResponseCache() if getattr(args, 'cache_reads', False) else None
+      self.pump = Pump(self.link, args.serial, wake_state=WakeState(), responses=responses)
 
     # Early return if we don't want to send any radio comms. Useful from both
     # the command line and for MMTuneApp
@@ -7,6 +7,7 @@ from base_mmeowlink_app import BaseMMeowlinkApp
 
 from mmeowlink.link_builder import LinkBuilder
 from mmeowlink.handlers.stick import Pump
+from mmeowlink.wake_state import WakeState
 
 
 class BolusApp (BaseMMeowlinkApp):
@@ -42,6 +43,7 @@ class BolusApp (BaseMMeowlinkApp):
     parser.add_argument('--radio_type', dest='radio_type', default='subg_rfspy', choices=['mmcommander', 'subg_rfspy'])
     parser.add_argument('--mmcommander', dest='radio_type', action='store_const', const='mmcommander')
     parser.add_argument('--subg_rfspy', dest='radio_type', action='store_const', const='subg_rfspy')
+    parser.add_argument('--max-symbol-corrections', dest='max_symbol_corrections', type=int, default=0, help="Try to correct up to this many corrupt symbols in each packet from a subg_rfspy radio, keeping the result only if its CRC checks out")
     # parser = super(BolusApp, self).customize_parser(parser)
 
     return parser
@@ -50,10 +52,10 @@ class BolusApp (BaseMMeowlinkApp):
       port = args.port
       builder = LinkBuilder()
       if port == 'scan':
-          port = builder.scan()
-      self.link = link = LinkBuilder().build(args.radio_type, port)
+          port = builder.scan(args.radio_type)
+      self.link = link = LinkBuilder().build(args.radio_type, port, max_symbol_corrections=args.max_symbol_corrections)
       link.open()
-      self.pump = Pump(self.link, args.serial)
+      self.pump = Pump(self.link, args.serial, wake_state=WakeState())
       self.model = None
       if args.no_rf_prelude:
           return
@@ -7,6 +7,8 @@ class SendMsgApp(BaseMMeowlinkApp):
   """
   def customize_parser(self, parser):
     parser = super(self.__class__, self).configure_radio_params(parser)
+    parser = super(self.__class__, self).configure_daemon_params(parser)
+    parser = super(self.__class__, self).configure_cache_params(parser)
     parser = super(self.__class__, self).customize_parser(parser)
 
     return parser
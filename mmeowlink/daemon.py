@@ -0,0 +1,315 @@
+"""
+Long-running radio daemon, and the client used to talk to it.
+
+The daemon opens the radio once and keeps it, along with a Pump per pump
+serial, serving requests over a Unix domain socket. That saves every
+report run from opening the port, checking it's free, syncing with the
+firmware and so on.
+
+Requests and responses are single lines of JSON, one of each per
+connection. Each request names an op (ping, execute, power_control or
+mmtune) and its arguments. Each response holds either 'result' or
+'error' and 'message'. Requests are served one at a time, which also
+keeps separate jobs from using the radio at the same time. After a
+request fails talking to the radio, the daemon checks the radio still
+answers, and reopens it if not, so one bad session doesn't leave every
+later request failing.
+
+Anyone who can connect can bolus, so the socket is only accessible by
+its owner, in $XDG_RUNTIME_DIR or ~/.mmeowlink, and the daemon refuses to
+listen in a directory that others can write to.
+"""
+
+import argparse
+import json
+import logging
+import os
+import select
+import socket
+import stat
+
+import serial
+from decocare import commands
+
+from cache import cache_path
+from exceptions import CommsException, InvalidPacketReceived
+from handlers.stick import Pump
+from link_builder import LinkBuilder
+from mmtune import MMTune
+from response_cache import ResponseCache
+from wake_state import WakeState
+
+io  = logging.getLogger( )
+log = io.getChild(__name__)
+
+def default_socket ( ):
+  runtime = os.environ.get('XDG_RUNTIME_DIR')
+  if runtime:
+    return os.path.join(runtime, 'mmeowlink-radio.sock')
+  return cache_path('radio.sock')
+
+DEFAULT_SOCKET = default_socket( )
+
+# How long a client gets to take its response
+REPLY_TIMEOUT = 5
+# Longest request line accepted
+MAX_REQUEST = 64 * 1024
+
+# Exceptions that are passed back to, and raised again in, the client
+REMOTE_EXCEPTIONS = dict((klass.__name__, klass) for klass in [CommsException, InvalidPacketReceived])
+# Exceptions from requests that may have left the radio in a bad way
+RADIO_EXCEPTIONS = (CommsException, InvalidPacketReceived, serial.SerialException, EnvironmentError)
+
+def command_fields (command):
+  """
+  The decocare class of command, and the parts of it that Sender needs in
+  order to run it
+  """
+  return dict(name=command.__class__.__name__, code=command.code, descr=command.descr,
+              params=list(command.params or [ ]), bytesPerRecord=command.bytesPerRecord,
+              maxRecords=command.maxRecords, retries=command.retries)
+
+def build_command (fields):
+  """
+  The decocare command command_fields describes, as an instance of its own
+  class so that it handles its response the same as it would locally
+  """
+  fields = dict(fields)
+  name = fields.pop('name', None)
+  klass = getattr(commands, name or '', None)
+  if not isinstance(klass, type) or not issubclass(klass, commands.PumpCommand):
+    raise ValueError("Unknown command class %s" % name)
+  command = klass(**fields)
+  if command.code != fields.get('code') or list(command.params or [ ]) != fields.get('params'):
+    raise ValueError("Can't rebuild %s with code %s and params %s" % (name, fields.get('code'), fields.get('params')))
+  return command
+
+def check_socket_dir (path):
+  """
+  Make sure only we can put a socket where path is, creating its
+  directory if need be
+  """
+  directory = os.path.dirname(os.path.abspath(path))
+  if not os.path.isdir(directory):
+    os.makedirs(directory, 0700)
+  info = os.stat(directory)
+  if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+    raise CommsException("Not listening in %s, which others can write to. Pass --socket somewhere only you can" % directory)
+
+class RadioDaemon (object):
+  # responses, a ResponseCache, is shared by all the pumps
+  def __init__ (self, link, path=DEFAULT_SOCKET, responses=None):
+    self.link = link
+    self.path = path
+    self.pumps = { }
+    self.wake_state = WakeState( )
+    self.responses = responses
+
+  def pump (self, serial):
+    if serial not in self.pumps:
+      self.pumps[serial] = Pump(self.link, serial, wake_state=self.wake_state, responses=self.responses)
+    return self.pumps[serial]
+
+  def serve_forever (self):
+    check_socket_dir(self.path)
+    if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+      os.unlink(self.path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Nobody else gets to connect, even between bind and chmod
+    umask = os.umask(0177)
+    try:
+      server.bind(self.path)
+    finally:
+      os.umask(umask)
+    os.chmod(self.path, 0600)
+    server.listen(5)
+    log.info("mmeowlink daemon listening on %s", self.path)
+    # Connected clients, with what they've sent so far. Requests are served
+    # as they come in, so a client that connects and says nothing doesn't
+    # hold up the rest
+    clients = { }
+    try:
+      while True:
+        readable, _, _ = select.select([ server ] + clients.keys(), [ ], [ ])
+        for conn in readable:
+          if conn is server:
+            conn, _ = server.accept()
+            clients[conn] = ''
+            continue
+          try:
+            done = self.handle(conn, clients)
+          except socket.error as e:
+            log.error("Client connection failed - %s", e)
+            done = True
+          if done:
+            del clients[conn]
+            conn.close()
+    finally:
+      for conn in clients:
+        conn.close()
+      server.close()
+      os.unlink(self.path)
+
+  # Reads what conn has sent, and once its request is in, answers it.
+  # Returns whether the connection is done with, since each carries only
+  # one request
+  def handle (self, conn, clients):
+    chunk = conn.recv(4096)
+    if not chunk:
+      return True
+    buf = clients[conn] = clients[conn] + chunk
+    if '\n' not in buf:
+      if len(buf) > MAX_REQUEST:
+        log.error("Dropping client with an overlong request")
+        return True
+      return False
+    line = buf.split('\n', 1)[0]
+    if line.strip():
+      conn.settimeout(REPLY_TIMEOUT)
+      conn.sendall(json.dumps(self.dispatch(line)) + '\n')
+    return True
+
+  def dispatch (self, line):
+    try:
+      request = json.loads(line)
+      op = getattr(self, 'op_%s' % request.pop('op'), None)
+      if op is None:
+        return dict(error='ValueError', message='Unknown op')
+      return dict(result=op(**request))
+    except Exception as e:
+      log.error("Request failed - %s: %s", e.__class__.__name__, e)
+      if isinstance(e, RADIO_EXCEPTIONS):
+        self.recover( )
+      return dict(error=e.__class__.__name__, message=str(e))
+
+  def recover (self):
+    """
+    Make sure the radio still answers, closing and opening it again if it
+    doesn't. A pump that's out of range looks the same as a radio that's
+    gone wrong, so this is done after either
+    """
+    link = self.link
+    try:
+      link.check_setup()
+      return
+    except Exception as e:
+      log.error("Radio not answering - %s - reopening %s", e, link.device)
+    try:
+      link.close()
+    except Exception as e:
+      log.debug("Closing radio failed - %s", e)
+      if link.serial is not None:
+        try:
+          link.serial.close()
+        except Exception:
+          pass
+        link.serial = None
+    try:
+      link.open()
+    except Exception as e:
+      log.error("Reopening radio failed - %s", e)
+
+  def op_ping (self):
+    return True
+
+  def op_execute (self, serial, command):
+    command = build_command(command)
+    if self.pump(serial).execute(command) is None:
+      raise CommsException("No response from pump to command %d" % command.code)
+    return str(command.data).encode('hex')
+
+  def op_power_control (self, serial, minutes=None):
+    return self.pump(serial).power_control(minutes=minutes)
+
+  def op_mmtune (self, serial, radio_locale='WW'):
+    return MMTune(self.link, serial, radio_locale).run()
+
+class RadioClient (object):
+  def __init__ (self, path=DEFAULT_SOCKET, timeout=None):
+    self.path = path
+    self.timeout = timeout
+    self.conn = None
+    self.stream = None
+
+  def connect (self):
+    if self.conn is None:
+      conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      conn.settimeout(self.timeout)
+      try:
+        conn.connect(self.path)
+      except socket.error as e:
+        conn.close()
+        raise CommsException("Could not connect to mmeowlink daemon at %s - %s" % (self.path, e))
+      self.conn = conn
+      self.stream = conn.makefile('rb')
+
+  def close (self):
+    if self.conn is not None:
+      self.stream.close()
+      self.conn.close()
+      self.conn = self.stream = None
+
+  # One connection per request: the daemon hangs up after answering
+  def request (self, op, **kwds):
+    self.connect()
+    kwds['op'] = op
+    try:
+      self.conn.sendall(json.dumps(kwds) + '\n')
+      line = self.stream.readline()
+    except socket.error as e:
+      raise CommsException("Lost connection to mmeowlink daemon - %s" % e)
+    finally:
+      self.close()
+    if not line:
+      raise CommsException("mmeowlink daemon closed the connection")
+
+    response = json.loads(line)
+    if 'error' in response:
+      klass = REMOTE_EXCEPTIONS.get(response['error'], CommsException)
+      raise klass("mmeowlink daemon: %s: %s" % (response['error'], response['message']))
+    return response['result']
+
+class RemotePump (Pump):
+  """
+  Pump that runs its commands through the daemon rather than a local link
+  """
+  def __init__ (self, serial, path=DEFAULT_SOCKET, client=None):
+    self.link = None
+    self.serial = serial
+    self.client = client or RadioClient(path)
+
+  def power_control (self, minutes=None):
+    return self.client.request('power_control', serial=self.serial, minutes=minutes)
+
+  # Like Pump.execute, returns None if the command failed
+  def execute (self, command):
+    command.serial = self.serial
+    try:
+      data = self.client.request('execute', serial=self.serial, command=command_fields(command))
+    except (CommsException, InvalidPacketReceived) as e:
+      log.error("%s", e)
+      return None
+    command.respond(bytearray(data.decode('hex')))
+    return command
+
+  def mmtune (self, radio_locale='WW'):
+    return self.client.request('mmtune', serial=self.serial, radio_locale=radio_locale)
+
+def main ( ):
+  parser = argparse.ArgumentParser(description="Keep the radio open and serve pump commands over a Unix socket")
+  parser.add_argument('--radio_type', dest='radio_type', default='subg_rfspy', choices=['mmcommander', 'subg_rfspy'])
+  parser.add_argument('--port', default='scan', help="Radio serial port. e.g. /dev/ttyACM0 or /dev/ttyMFD1")
+  parser.add_argument('--socket', default=DEFAULT_SOCKET, help="Path of the socket to listen on")
+  parser.add_argument('--max-symbol-corrections', dest='max_symbol_corrections', type=int, default=0, help="Try to correct up to this many corrupt symbols in each packet from a subg_rfspy radio, keeping the result only if its CRC checks out")
+  parser.add_argument('--cache-reads', dest='cache_reads', action='store_true', help="Answer reads of settings that hardly ever change from ~/.mmeowlink/responses.json while they're fresh")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  builder = LinkBuilder( )
+  port = args.port
+  if port == 'scan':
+    port = builder.scan(args.radio_type)
+  link = builder.build(args.radio_type, port, max_symbol_corrections=args.max_symbol_corrections)
+
+  responses = ResponseCache() if args.cache_reads else None
+  RadioDaemon(link, path=args.socket, responses=responses).serve_forever()
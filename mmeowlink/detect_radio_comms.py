@@ -1,47 +1,52 @@
 import time
 
-from exceptions import CommsException
+from exceptions import CommsException, InvalidPacketReceived
 from hex_handling import hexify
+from packets.rf import LazyPacket
 
 from vendors.mmcommander_link import MMCommanderLink
 from vendors.subg_rfspy_link import SubgRfspyLink
 
 class DetectRadioComms(object):
-  def __init__(self, link=None, wait_for=5, ignore_wake=False):
+  # serial, if given, only counts comms with that pump
+  def __init__(self, link=None, wait_for=5, ignore_wake=False, serial=None):
     self.link = link
     self.wait_for = wait_for
     self.ignore_wake = ignore_wake
+    self.serial = serial
 
   def detect(self):
     start = time.time()
-    assert self.wait_for >= 1
+    assert self.wait_for > 0
 
     # We wait for packets 1 second at a time so that we don't exceed the
     # firmware timeout value with 0.6 firmware:
     while time.time() <= start + self.wait_for:
-      hex_string = None
+      data = None
+      timeout = max(min(1, start + self.wait_for - time.time()), 0.001)
 
       try:
         if type(self.link) == SubgRfspyLink:
-          resp = self.link.get_packet(timeout=1)
-          hex_string = hexify(resp['data']).upper()
+          data = self.link.get_packet(timeout=timeout)['data']
         elif type(self.link) == MMCommanderLink:
-          resp = self.link.read(timeout=1)
-          hex_string = hexify(resp).upper()
-      except CommsException as e:
+          data = self.link.read(timeout=timeout)
+      except (CommsException, InvalidPacketReceived) as e:
         pass
 
-      # EG:   A7 12 31 23 22 5D .. ..
-      # POS:  01234567890123456789
-      #   'A7' indicates comms with the pump
-      if hex_string:
-        if (hex_string[0:2] == 'A7'):
-          if hex_string[15:16] == '5D' and self.ignore_wake:
+      # EG:   A7 123123 5D .. ..
+      #   0xA7 indicates comms with the pump, followed by its serial and
+      #   the op
+      if data:
+        packet = LazyPacket(bytearray(data))
+        if packet.type == 0xA7:
+          if packet.op == 0x5D and self.ignore_wake:
+            pass
+          elif self.serial and packet.serial != self.serial.lower():
             pass
           else:
             return(1)
         else:
-          print('Picked up something other than pump comms - ignoring: %s' % hex_string)
+          print('Picked up something other than pump comms - ignoring: %s' % hexify(data).upper())
 
     # No comms picked up
     return(0)
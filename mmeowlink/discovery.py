@@ -0,0 +1,295 @@
+"""
+Finding radios.
+
+Every likely port (/dev/serial/by-id links, ttyACM*, ttyMFD* and spidev)
+is probed at the same time, each with a short version handshake that tells
+subg_rfspy and MMCommander apart. USB ports are only probed if they look
+like one of those radios - a CC111x stick from Texas Instruments, or named
+for its firmware - and built-in UARTs only if they're the ones radio
+boards are wired to, unless probe_unknown says otherwise, so that other
+serial devices aren't sent bytes they don't expect. The system console
+is never probed, and nor is a port another program has open. The SPI radio is
+probed once, on its own. What was found is cached on disk keyed by
+port, along with the radio's USB serial number, so later runs only need to
+stat the port - or, if the radio's come back under another name, find it
+again by its serial number.
+"""
+
+import glob
+import logging
+import os
+import threading
+import time
+
+import serial
+
+import fuser
+from cache import cache_path, load_json, save_json
+from vendors.serial_rf_spy import SerialRfSpy
+from vendors.mmcommander_link import MMCommanderLink
+
+io  = logging.getLogger( )
+log = io.getChild(__name__)
+
+SUBG_RFSPY = 'subg_rfspy'
+MMCOMMANDER = 'mmcommander'
+
+BY_ID_GLOB = '/dev/serial/by-id/*'
+# In order of preference. Ports reached by more than one of these are only
+# probed under the first name found
+CANDIDATE_GLOBS = [BY_ID_GLOB, '/dev/ttyACM*', '/dev/ttyMFD*', '/dev/spidev*']
+
+# USB vendor ids of the radios: the CC1110/CC1111 sticks both firmwares run
+# on are Texas Instruments parts
+RADIO_USB_VENDORS = [ '0451' ]
+# Words in /dev/serial/by-id names that identify a radio
+RADIO_NAMES = [ SUBG_RFSPY, MMCOMMANDER ]
+# Built-in UARTs radio boards are wired to: UART1 on the Edison, which the
+# Explorer board uses. ttyMFD2 there is the console
+RADIO_UARTS = [ 'ttyMFD1' ]
+
+PROBE_TIMEOUT = 0.5
+CACHE_TTL = 24 * 60 * 60
+CACHE_FILE = 'radios.json'
+
+def candidate_ports (probe_unknown=False):
+  seen = set( )
+  ports = [ ]
+  spi = False
+  for pattern in CANDIDATE_GLOBS:
+    for port in sorted(glob.glob(pattern)):
+      real = os.path.realpath(port)
+      if real in seen:
+        continue
+      seen.add(real)
+      if is_spi(port):
+        # The SPI radio is reached the same way whichever node is named
+        if spi:
+          continue
+        spi = True
+      elif is_console(port):
+        log.debug("Not probing %s, the system console", port)
+        continue
+      elif not probe_unknown and (is_usb(port) or is_uart(port)) and not looks_like_radio(port):
+        log.debug("Not probing %s, which doesn't look like a radio", port)
+        continue
+      ports.append(port)
+  # Anything that says it's subg_rfspy goes first. sort is stable, so the
+  # order above is otherwise kept
+  ports.sort(key=lambda port: SUBG_RFSPY not in port)
+  return ports
+
+def is_spi (port):
+  return 'spi' in port
+
+def is_usb (port):
+  return port.startswith(os.path.dirname(BY_ID_GLOB)) or 'ttyACM' in port
+
+def is_uart (port):
+  return 'ttyMFD' in port
+
+def is_console (port):
+  """
+  Whether port is where the kernel sends its console
+  """
+  try:
+    with open('/sys/class/tty/console/active') as f:
+      consoles = f.read().split()
+  except (IOError, OSError):
+    return False
+  return os.path.basename(os.path.realpath(port)) in consoles
+
+def usb_attribute (port, attribute):
+  """
+  An attribute, such as serial or idVendor, of the USB device behind port
+  """
+  name = os.path.basename(os.path.realpath(port))
+  try:
+    with open(os.path.join('/sys/class/tty', name, 'device', '..', attribute)) as f:
+      return f.read().strip() or None
+  except (IOError, OSError):
+    return None
+
+def usb_serial (port):
+  """
+  Serial number of the USB device behind port, if it has one
+  """
+  return usb_attribute(port, 'serial')
+
+def looks_like_radio (port):
+  if is_uart(port):
+    return os.path.basename(port) in RADIO_UARTS
+  names = [ os.path.basename(port).lower( ) ]
+  names.extend(os.path.basename(link).lower( ) for link in glob.glob(BY_ID_GLOB)
+               if os.path.realpath(link) == os.path.realpath(port))
+  if any(word in name for name in names for word in RADIO_NAMES):
+    return True
+  return usb_attribute(port, 'idVendor') in RADIO_USB_VENDORS
+
+def probe (port, timeout=PROBE_TIMEOUT):
+  """
+  Ask what's on port. Returns SUBG_RFSPY, MMCOMMANDER, or None if it's
+  neither, or couldn't be checked
+  """
+  # Opening a tty resets its settings, so leave alone any that someone
+  # else is using
+  if fuser.in_use(port):
+    log.info("Not probing %s, it's in use", port)
+    return None
+  try:
+    if is_spi(port):
+      import spi_serial
+      ser = spi_serial.SpiSerial()
+      fd = None
+    else:
+      ser = serial.Serial(port, 19200, timeout=timeout, writeTimeout=timeout)
+      fd = ser.fileno()
+  except (ImportError, serial.SerialException, OSError) as e:
+    log.debug("Could not open %s - %s", port, e)
+    return None
+
+  try:
+    # Nor anyone who opened it since, or is using it through a lock
+    if not fuser.lock(port, fd):
+      log.info("Not probing %s, it's in use", port)
+      return None
+
+    rf_spy = SerialRfSpy(ser)
+    version = rf_spy.do_command(rf_spy.CMD_GET_VERSION, timeout=timeout)
+    if SUBG_RFSPY in str(version):
+      return SUBG_RFSPY
+    if fd is None:
+      return None
+
+    ser.baudrate = 57600
+    ser.flushInput()
+    ser.write(chr(MMCommanderLink.VERSION_FETCH_COMMAND))
+    if len(ser.read(1)) > 0:
+      return MMCOMMANDER
+    return None
+  except (serial.SerialException, OSError) as e:
+    log.debug("Probing %s failed - %s", port, e)
+    return None
+  finally:
+    ser.close()
+
+def probe_all (ports, timeout=PROBE_TIMEOUT):
+  """
+  Probe ports in parallel, apart from SPI, which is probed on its own.
+  Returns a list of (port, radio_type) in the same order, once every
+  probe is over and its port closed again
+  """
+  found = { }
+  def run (port):
+    found[port] = probe(port, timeout)
+
+  threads = [ ]
+  for port in ports:
+    if is_spi(port):
+      continue
+    thread = threading.Thread(target=run, args=(port,), name='probe %s' % port)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+
+  for port in ports:
+    if is_spi(port):
+      run(port)
+  # Reads and writes time out, so every probe finishes
+  for thread in threads:
+    thread.join()
+  return [(port, found.get(port)) for port in ports]
+
+class Discovery (object):
+  # probe_unknown also probes USB serial ports that don't look like radios
+  def __init__ (self, path=None, ttl=CACHE_TTL, timeout=PROBE_TIMEOUT, probe_unknown=False):
+    self.path = path or cache_path(CACHE_FILE)
+    self.ttl = ttl
+    self.timeout = timeout
+    self.probe_unknown = probe_unknown
+
+  def load (self):
+    radios = load_json(self.path, { }).get('radios', { })
+    now = time.time()
+    return dict((port, entry) for port, entry in radios.items()
+                if now - entry.get('checked', 0) < self.ttl)
+
+  def save (self, radios):
+    save_json(self.path, dict(radios=radios))
+
+  def entry (self, port, radio_type):
+    return dict(radio_type=radio_type, usb_serial=usb_serial(port),
+                rdev=os.stat(port).st_rdev, checked=time.time())
+
+  def locate (self, port, entry):
+    """
+    Where the radio recorded as being on port is now, or None
+    """
+    try:
+      if os.stat(port).st_rdev == entry['rdev']:
+        # by-id names include the serial number, others need checking
+        if port.startswith(os.path.dirname(BY_ID_GLOB)) or usb_serial(port) == entry['usb_serial']:
+          return port
+    except OSError:
+      pass
+
+    # It may have been plugged back in and given another name
+    if entry['usb_serial']:
+      for link in glob.glob(BY_ID_GLOB):
+        if entry['usb_serial'] in os.path.basename(link):
+          return link
+    return None
+
+  def cached (self, radio_type=None):
+    """
+    (port, radio_type) for the first cached radio still present
+    """
+    for port, entry in sorted(self.load().items()):
+      if radio_type and entry['radio_type'] != radio_type:
+        continue
+      found = self.locate(port, entry)
+      if found:
+        return found, entry['radio_type']
+    return None, None
+
+  def scan (self, radio_type=None, refresh=False):
+    """
+    Find a radio, of radio_type if given. Returns (port, radio_type), or
+    (None, None) if there isn't one
+    """
+    if not refresh:
+      port, found_type = self.cached(radio_type)
+      if port:
+        log.debug("Using cached %s radio on %s", found_type, port)
+        return port, found_type
+
+    radios = self.load()
+    result = (None, None)
+    for port, found_type in probe_all(candidate_ports(self.probe_unknown), self.timeout):
+      if found_type is None:
+        continue
+      radios[port] = self.entry(port, found_type)
+      if result[0] is None and radio_type in (None, found_type):
+        result = (port, found_type)
+    self.save(radios)
+    return result
+
+  def radio_type (self, port):
+    """
+    What's on port, from the cache or by probing it
+    """
+    radios = self.load()
+    entry = radios.get(port)
+    if entry and self.locate(port, entry) == port:
+      return entry['radio_type']
+
+    found_type = probe(port, self.timeout)
+    if found_type:
+      radios[port] = self.entry(port, found_type)
+      self.save(radios)
+    return found_type
+
+  def forget (self, port):
+    radios = self.load()
+    if radios.pop(port, None):
+      self.save(radios)
@@ -0,0 +1,467 @@
+"""
+A stand-in for a subg_rfspy radio and a Medtronic pump, for running and
+timing mmeowlink without any hardware.
+
+SubgRfspyEmulator opens a pseudo-terminal and answers the serial protocol
+SerialRfSpy speaks on it (GET_STATE, GET_VERSION, GET_PACKET, SEND_PACKET,
+SEND_AND_LISTEN, UPDATE_REGISTER and RESET). Packets it transmits go to a
+PumpEmulator, whose replies come back over the air after a configurable
+delay, with an RSSI that depends on how far the radio is tuned from the
+pump, and with optional loss and bit errors:
+
+  emulator = SubgRfspyEmulator(PumpEmulator('208850', awake=True))
+  emulator.start()
+  link = SubgRfspyLink(emulator.port)
+
+The pump answers wakeups, ack-ed commands with parameters, single-frame
+reads (model, clock, battery, reservoir and anything else in its responses
+table) and multi-frame history pages. Times are real: a 500 packet wakeup
+takes as long as packet_time says it does.
+
+  python -m mmeowlink.emulator --serial 208850
+
+runs one until interrupted, printing the port to use.
+"""
+
+import argparse
+import errno
+import logging
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+
+from decocare.lib import CRC16CCITT
+
+from mmeowlink.exceptions import InvalidPacketReceived
+from mmeowlink.fourbysix import FourBySix
+from mmeowlink.packets.rf import FrameTemplate, LazyPacket
+from mmeowlink.vendors.serial_rf_spy import SerialRfSpy
+from mmeowlink.vendors.subg_rfspy_link import SubgRfspyLink
+
+io  = logging.getLogger( )
+log = io.getChild(__name__)
+
+def frequency_rssi (center, peak=-45, bandwidth=0.2):
+  """
+  An RSSI function for SubgRfspyEmulator: peak dBm at center MHz, falling
+  off linearly to -95 at bandwidth MHz either side, beyond which nothing
+  gets through
+  """
+  def rssi (freq_mhz):
+    offset = abs(freq_mhz - center)
+    if offset > bandwidth:
+      return None
+    return peak - (peak + 95) * offset / bandwidth
+  return rssi
+
+class PumpEmulator (object):
+  OP_ACK = 0x06
+  OP_NAK = 0x15
+  OP_POWER_CONTROL = 0x5d
+  OP_HISTORY = 0x80
+
+  FRAME_SIZE = 64
+  PAGE_FRAMES = 16
+  LAST_FRAME = 0x80
+
+  # Reply payloads for single-frame reads, before padding to a full frame
+  RESPONSES = {
+    0x8d: bytearray('0903353232'.decode('hex')),        # model 522
+    0x70: bytearray('070e291c07e00a12'.decode('hex')),  # clock
+    0x72: bytearray('0300008c'.decode('hex')),          # battery
+    0x73: bytearray('02056400'.decode('hex')),          # reservoir
+    0xce: bytearray('03010000'.decode('hex')),          # status: normal
+    0x98: bytearray('06000000000000'.decode('hex')),    # no temp basal
+    0xc0: bytearray('19'.decode('hex')),                # settings
+  }
+
+  # Commands that are ack-ed, then sent their parameters in a second frame
+  PARAM_COMMANDS = set([OP_POWER_CONTROL, OP_HISTORY, 0x42, 0x4c, 0x81])
+
+  def __init__ (self, serial='208850', frequency=916.55, awake=False, awake_seconds=600,
+                wake_packets=50, responses=None, history_pages=32, seed=1):
+    self.serial = serial
+    self.frequency = frequency
+    self.awake_seconds = awake_seconds
+    self.awake_until = awake and time.time() + awake_seconds or 0
+    # How many power control packets in a row it takes to wake the pump
+    self.wake_packets = wake_packets
+    self.responses = dict(self.RESPONSES)
+    self.responses.update(responses or { })
+    self.history_pages = history_pages
+    self.pages = { }
+    self.random = random.Random(seed)
+
+    self.wake_count = 0
+    self.last_heard = 0
+    # op we acked and are waiting for parameters for
+    self.pending = None
+    # Frames still to send of a multi-frame response
+    self.outgoing = [ ]
+    self.received = 0
+
+  def is_awake (self, now=None):
+    return (now or time.time()) < self.awake_until
+
+  def frame (self, op, payload):
+    padded = bytearray(payload) + bytearray(max(0, self.FRAME_SIZE + 1 - len(payload)))
+    return FrameTemplate.get(self.serial, op).assemble(padded)
+
+  def ack (self):
+    return self.frame(self.OP_ACK, bytearray([0]))
+
+  def history_page (self, page):
+    if page not in self.pages:
+      size = self.FRAME_SIZE * self.PAGE_FRAMES
+      data = bytearray(self.random.getrandbits(8) for _ in range(size - 2))
+      crc = CRC16CCITT.compute(data)
+      data.extend([crc >> 8, crc & 0xff])
+      self.pages[page] = data
+    return self.pages[page]
+
+  def history_frames (self, page):
+    data = self.history_page(page)
+    frames = [ ]
+    for index in range(self.PAGE_FRAMES):
+      num = index + 1
+      if num == self.PAGE_FRAMES:
+        num |= self.LAST_FRAME
+      chunk = data[index * self.FRAME_SIZE:(index + 1) * self.FRAME_SIZE]
+      frames.append(self.frame(self.OP_HISTORY, bytearray([num]) + chunk))
+    return frames
+
+  def receive (self, buf, now=None):
+    """
+    Handle a frame heard from the radio. Returns the frame to send back, or
+    None to stay quiet
+    """
+    now = now or time.time()
+    packet = LazyPacket(buf)
+    if not packet.valid or packet.serial != self.serial:
+      return None
+    self.received += 1
+    op, payload = packet.op, packet.payload
+
+    if not self.is_awake(now):
+      if op != self.OP_POWER_CONTROL:
+        self.wake_count = 0
+        return None
+      # A gap means a new wakeup attempt
+      if now - self.last_heard > 1:
+        self.wake_count = 0
+      self.last_heard = now
+      self.wake_count += 1
+      if self.wake_count < self.wake_packets:
+        return None
+      log.debug("Pump %s woken after %d packets", self.serial, self.wake_count)
+      self.awake_until = now + self.awake_seconds
+      self.wake_count = 0
+      return self.ack()
+
+    self.awake_until = max(self.awake_until, now + 60)
+
+    if op == self.OP_ACK:
+      if self.outgoing:
+        return self.outgoing.pop(0)
+      return None
+
+    # The prelude is a one byte payload; the parameters fill a frame
+    if len(payload) <= 1:
+      self.outgoing = [ ]
+      if op in self.PARAM_COMMANDS:
+        self.pending = op
+        return self.ack()
+      self.pending = None
+      if op not in self.responses:
+        return self.frame(self.OP_NAK, bytearray([0]))
+      return self.frame(op, self.responses[op])
+
+    if op != self.pending:
+      return self.frame(self.OP_NAK, bytearray([0]))
+    self.pending = None
+    params = payload[1:1 + payload[0]]
+    if op == self.OP_HISTORY:
+      page = params[0] if params else 0
+      if page >= self.history_pages:
+        return self.frame(self.OP_NAK, bytearray([0]))
+      self.outgoing = self.history_frames(page)
+      return self.outgoing.pop(0)
+    if op == self.OP_POWER_CONTROL and len(params) > 1:
+      self.awake_until = now + params[1] * 60
+    return self.ack()
+
+class SubgRfspyEmulator (object):
+  VERSION = 'subg_rfspy 0.9'
+
+  def __init__ (self, pump=None, version=VERSION, reply_latency=0.005, packet_time=0.016,
+                rssi=None, corruption_rate=0, drop_rate=0, seed=1):
+    self.pump = pump or PumpEmulator()
+    self.version = version
+    # How long the pump takes to start replying once a transmission ends
+    self.reply_latency = reply_latency
+    # How long each packet takes to send
+    self.packet_time = packet_time
+    # Maps the frequency tuned to, in MHz, to the RSSI either side hears
+    # the other at, or None if they can't
+    self.rssi = rssi or frequency_rssi(self.pump.frequency)
+    # Chance of a packet being lost, in either direction
+    self.drop_rate = drop_rate
+    # Chance of a packet from the pump arriving with a bit flipped
+    self.corruption_rate = corruption_rate
+    self.random = random.Random(seed)
+
+    self.registers = { }
+    self.sequence = 0
+    # Packets on the air for the radio to hear: (time sent, frame)
+    self.air = [ ]
+    self.lock = threading.Lock()
+    self.buf = bytearray()
+    self.master = None
+    self.port = None
+    self.thread = None
+    self.running = False
+    self.commands = 0
+
+  def start (self):
+    self.master, slave = pty.openpty()
+    tty.setraw(self.master)
+    tty.setraw(slave)
+    self.port = os.ttyname(slave)
+    os.close(slave)
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name='subg_rfspy emulator')
+    self.thread.daemon = True
+    self.thread.start()
+    return self.port
+
+  def stop (self):
+    self.running = False
+    if self.thread:
+      self.thread.join()
+    os.close(self.master)
+
+  def inject (self, frame, delay=0):
+    """
+    Put a packet on the air, as if from another device
+    """
+    with self.lock:
+      self.air.append((time.time() + delay, bytearray(frame)))
+
+  # Current frequency in MHz, or None if the registers haven't been set
+  def frequency (self):
+    regs = [ self.registers.get(reg) for reg in
+             (SubgRfspyLink.REG_FREQ2, SubgRfspyLink.REG_FREQ1, SubgRfspyLink.REG_FREQ0) ]
+    if None in regs:
+      return None
+    val = (regs[0] << 16) | (regs[1] << 8) | regs[2]
+    return val * (SubgRfspyLink.FREQ_XTAL / float(2**16)) / 1000000
+
+  def link_rssi (self):
+    freq = self.frequency()
+    return self.rssi(self.pump.frequency if freq is None else freq)
+
+  def run (self):
+    while self.running:
+      command = self.next_command(0.1)
+      if command is None:
+        continue
+      self.commands += 1
+      try:
+        self.handle(*command)
+      except OSError as e:
+        if e.errno != errno.EIO:
+          raise
+        # Nobody has the port open
+        self.buf = bytearray()
+
+  def read_input (self, timeout):
+    readable, _, _ = select.select([self.master], [], [], max(timeout, 0))
+    if not readable:
+      return False
+    try:
+      self.buf.extend(os.read(self.master, 4096))
+    except OSError as e:
+      if e.errno != errno.EIO:
+        raise
+      # Nobody has the port open
+      time.sleep(min(max(timeout, 0), 0.1))
+      return False
+    return True
+
+  # Splits the next command off the input, waiting up to timeout for it to
+  # arrive. Returns (command, params) or None
+  def next_command (self, timeout):
+    deadline = time.time() + timeout
+    while True:
+      command = self.parse()
+      if command is not None:
+        return command
+      remaining = deadline - time.time()
+      if remaining <= 0 or not self.read_input(remaining):
+        return None
+
+  def timeout_width (self):
+    return 2 if self.version.split(' ')[-1] in SubgRfspyLink.UINT16_TIMEOUT_VERSIONS else 4
+
+  def parse (self):
+    buf = self.buf
+    if not buf:
+      return None
+    command = buf[0]
+    header = {
+      SerialRfSpy.CMD_GET_PACKET: 1 + self.timeout_width(),
+      SerialRfSpy.CMD_SEND_PACKET: 3,
+      SerialRfSpy.CMD_SEND_AND_LISTEN: 4 + self.timeout_width() + 1,
+      SerialRfSpy.CMD_UPDATE_REGISTER: 2,
+    }.get(command, 0)
+    if len(buf) < 1 + header:
+      return None
+    end = 1 + header
+    # Packets to send run up to and including their 0x00 terminator
+    if command in (SerialRfSpy.CMD_SEND_PACKET, SerialRfSpy.CMD_SEND_AND_LISTEN):
+      end = buf.find(b'\x00', end)
+      if end < 0:
+        return None
+      end += 1
+    params = buf[1:end]
+    del buf[:end]
+    return command, params
+
+  def reply (self, data):
+    os.write(self.master, str(data) + '\x00')
+
+  def handle (self, command, params):
+    if command == SerialRfSpy.CMD_GET_STATE:
+      self.reply('OK')
+    elif command == SerialRfSpy.CMD_GET_VERSION:
+      self.reply(self.version)
+    elif command == SerialRfSpy.CMD_UPDATE_REGISTER:
+      self.registers[params[0]] = params[1]
+      self.reply(bytearray([SubgRfspyLink.REGISTER_UPDATED]))
+    elif command == SerialRfSpy.CMD_RESET:
+      self.registers = { }
+    elif command == SerialRfSpy.CMD_SEND_PACKET:
+      self.transmit(params[3:], params[1] + 1, params[2])
+      self.reply('')
+    elif command == SerialRfSpy.CMD_SEND_AND_LISTEN:
+      width = self.timeout_width()
+      self.transmit(params[4 + width + 1:], params[1] + 1, params[2])
+      self.listen(self.decode_timeout(params[4:4 + width]))
+    elif command == SerialRfSpy.CMD_GET_PACKET:
+      self.listen(self.decode_timeout(params[1:]))
+    else:
+      log.debug("Ignoring unknown command %d", command)
+
+  def decode_timeout (self, raw):
+    timeout_ms = 0
+    for byte in raw:
+      timeout_ms = (timeout_ms << 8) | byte
+    return timeout_ms / 1000.0
+
+  def transmit (self, encoded, repetitions, delay_ms):
+    try:
+      frame = FourBySix.decode(encoded)
+    except InvalidPacketReceived:
+      frame = None
+
+    reply = None
+    heard = frame is not None and self.link_rssi() is not None
+    for _ in range(repetitions):
+      time.sleep(self.packet_time)
+      if heard and self.random.random() >= self.drop_rate:
+        reply = self.pump.receive(frame) or reply
+      if delay_ms:
+        time.sleep(delay_ms / 1000.0)
+
+    if reply is not None:
+      with self.lock:
+        self.air.append((time.time() + self.reply_latency, reply))
+
+  # Takes the first packet heard by now off the air. Ones that finished
+  # before the radio started listening are gone.
+  def heard (self, start, now):
+    with self.lock:
+      self.air = [ (sent, frame) for sent, frame in self.air if sent + self.packet_time >= start ]
+      for index, (sent, frame) in enumerate(self.air):
+        if sent <= now:
+          del self.air[index]
+          return frame
+    return None
+
+  def next_on_air (self):
+    with self.lock:
+      if self.air:
+        return min(sent for sent, frame in self.air)
+    return None
+
+  def listen (self, timeout):
+    start = time.time()
+    deadline = timeout and start + timeout
+    while self.running:
+      now = time.time()
+      frame = self.heard(start, now)
+      if frame is not None:
+        rssi = self.link_rssi()
+        if rssi is not None and self.random.random() >= self.drop_rate:
+          self.reply(self.packet_response(frame, rssi))
+          return
+        continue
+
+      if deadline and now >= deadline:
+        self.reply(bytearray([SerialRfSpy.RFSPY_ERROR_TIMEOUT]))
+        return
+      wait = 0.1
+      if deadline:
+        wait = min(wait, deadline - now)
+      upcoming = self.next_on_air()
+      if upcoming is not None:
+        wait = min(wait, max(upcoming - now, 0))
+      # A new command cuts listening short
+      if self.buf or self.read_input(wait):
+        self.reply(bytearray([SerialRfSpy.RFSPY_ERROR_COMMAND_INTERRUPTED]))
+        return
+
+  def packet_response (self, frame, rssi):
+    raw = int((rssi + 73) * 2) & 0xff
+    self.sequence = self.sequence % 255 + 1
+    encoded = FourBySix.encode(frame)
+    if self.random.random() < self.corruption_rate:
+      # Flip a bit in the symbols, but never leave a 0x00 that would end
+      # the response early
+      while True:
+        index = self.random.randrange(len(encoded) - 1)
+        flipped = encoded[index] ^ (1 << self.random.randrange(8))
+        if flipped:
+          encoded[index] = flipped
+          break
+    # The encoding ends with the 0x00 that terminates the response
+    return bytearray([raw or 1, self.sequence]) + encoded[:-1]
+
+def main ( ):
+  parser = argparse.ArgumentParser(description="Emulate a subg_rfspy radio and a pump on a pseudo-terminal")
+  parser.add_argument('--serial', default='208850', help="Pump serial number")
+  parser.add_argument('--frequency', type=float, default=916.55, help="Pump frequency in MHz")
+  parser.add_argument('--asleep', action='store_true', help="Start with the pump asleep")
+  parser.add_argument('--reply-latency', type=float, default=0.005, help="Seconds before the pump replies")
+  parser.add_argument('--packet-time', type=float, default=0.016, help="Seconds to send each packet")
+  parser.add_argument('--corruption-rate', type=float, default=0, help="Chance of a bit error in each packet from the pump")
+  parser.add_argument('--drop-rate', type=float, default=0, help="Chance of losing each packet")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  pump = PumpEmulator(args.serial, frequency=args.frequency, awake=not args.asleep)
+  emulator = SubgRfspyEmulator(pump, reply_latency=args.reply_latency, packet_time=args.packet_time,
+                               corruption_rate=args.corruption_rate, drop_rate=args.drop_rate)
+  print emulator.start()
+  try:
+    while True:
+      time.sleep(60)
+  except KeyboardInterrupt:
+    emulator.stop()
+
+if __name__ == '__main__':
+  main()
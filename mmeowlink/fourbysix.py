@@ -1,5 +1,23 @@
+import itertools
+
+from decocare.lib import CRC8
+
 from exceptions import InvalidPacketReceived
 
+def _build_decode_table (codes):
+  # Maps every possible 6-bit word to its nibble, or None if it isn't a code
+  table = [ None ] * 64
+  for nibble, code in enumerate(codes):
+    table[code] = nibble
+  return table
+
+def _build_encode_table (codes):
+  # Maps every byte to the 12-bit codeword made of its two nibble codes
+  return [ (codes[b >> 4] << 6) | codes[b & 0xf] for b in range(256) ]
+
+def _crc8_matches (data):
+  return len(data) > 1 and CRC8.compute(data[:-1]) == data[-1]
+
 class FourBySix (object):
   SYMBOLS = {
     "010101" : "0",
@@ -38,51 +56,214 @@ class FourBySix (object):
     0b001110,
     0b011100
   ]
+
+  DECODE_TABLE = _build_decode_table(CODES)
+  ENCODE_TABLE = _build_encode_table(CODES)
+
   @classmethod
   def encode (klass, buf):
-    codes = [ ]
-    for b in list(buf):
-      codes.append(klass.CODES[( b >> 4 )])
-      codes.append(klass.CODES[( b & 0xf )])
-    bits = [ ]
-    for code in codes:
-      bits.append("{:06b}".format(code))
-    bits = ''.join(bits) + "000000000000"
-    remaining = bits[:]
-    out = [ ]
-    while len(remaining) > 7:
-      byte_bits, remaining = remaining[0:8], remaining[8:]
-      out.append(int(byte_bits, 2))
-    return bytearray(out)
+    table = klass.ENCODE_TABLE
+    length = len(buf)
+    # 12 bits per byte, followed by two 000000 terminator symbols, truncated
+    # to whole bytes
+    out = bytearray((length * 12 + 12) // 8)
+    pos = 0
+    for i in range(0, length - 1, 2):
+      word = (table[buf[i]] << 12) | table[buf[i + 1]]
+      out[pos] = word >> 16
+      out[pos + 1] = (word >> 8) & 0xff
+      out[pos + 2] = word & 0xff
+      pos += 3
+    if length & 1:
+      word = table[buf[-1]]
+      out[pos] = word >> 4
+      out[pos + 1] = (word & 0xf) << 4
+    return out
 
   @classmethod
-  def decode (klass, buf):
+  def encode_many (klass, frames):
+    return [ klass.encode(frame) for frame in frames ]
+
+  @classmethod
+  def decode_with_errors (klass, buf):
+    """
+    Decode buf up to the 000000 terminator without raising.
+
+    Returns (data, symbols, errors): data holds the decoded bytes (a trailing
+    odd nibble is dropped), symbols is the number of 6-bit symbols read before
+    the terminator, and errors lists the symbol offsets of invalid codes. The
+    nibble for an invalid code is left as zero so that offsets stay aligned.
+    """
+    table = klass.DECODE_TABLE
     errors = [ ]
-    symbols = [ ]
-    data = bytearray( )
-    bits = [ ]
+    # Each byte carries 8/6 of a symbol, and every two symbols make a byte
+    data = bytearray((len(buf) * 8 // 6 + 1) // 2)
+    acc = 0
+    bits = 0
+    symbols = 0
+    terminated = False
     for byte in buf:
-      bits.append("{:08b}".format(byte))
-    # bits is now a long string of 1s and 0s '10010100101...000000'
-    bits = ''.join(bits)
-    while bits:
-      # iterate 6 bits at a time
-      word, bits = bits[:6], bits[6:]
-      if word == '000000':
+      acc = (acc << 8) | byte
+      bits += 8
+      while bits >= 6:
+        bits -= 6
+        code = (acc >> bits) & 0x3f
+        if code == 0:
+          terminated = True
+          break
+        nibble = table[code]
+        if nibble is None:
+          errors.append(symbols)
+        elif symbols & 1:
+          data[symbols >> 1] |= nibble
+        else:
+          data[symbols >> 1] = nibble << 4
+        symbols += 1
+      if terminated:
         break
-      symbol = klass.SYMBOLS.get(word, None)
-      if symbol is None:
-        errors.append(dict(remaining=bits, word=word))
-      else:
-        symbols.append(symbol)
+      acc &= (1 << bits) - 1
+
+    # Any trailing bits that don't make up a whole symbol are padding
+    del data[symbols >> 1:]
+    return data, symbols, errors
 
-    decoded_hex = ''.join(symbols)
-    if (len(decoded_hex) % 2) != 0:
-      decoded_hex = decoded_hex + "\x00"
+  @classmethod
+  def decode (klass, buf):
+    data, symbols, errors = klass.decode_with_errors(buf)
 
-    try:
-      data = bytearray(str(decoded_hex).decode('hex'))
-    except TypeError as e:
-      raise InvalidPacketReceived("Error decoding FourBySix packet")
+    if errors:
+      raise InvalidPacketReceived("Error decoding FourBySix packet - invalid symbols at offsets %s" % errors)
+
+    if (symbols % 2) != 0:
+      raise InvalidPacketReceived("Error decoding FourBySix packet - odd number of symbols (%d)" % symbols)
 
     return data
+
+  @classmethod
+  def symbol_at (klass, buf, offset):
+    """
+    Returns the raw 6-bit word of the symbol at the given offset in buf
+    """
+    byte, shift = divmod(offset * 6, 8)
+    word = buf[byte] << 8
+    if byte + 1 < len(buf):
+      word |= buf[byte + 1]
+    return (word >> (10 - shift)) & 0x3f
+
+  @classmethod
+  def recover (klass, buf, max_errors=1, check=_crc8_matches):
+    """
+    Decode buf, trying to correct up to max_errors invalid symbols.
+
+    Each invalid symbol is replaced by the codes nearest to it by Hamming
+    distance, and every combination is tried against check, which by
+    default verifies the trailing CRC8 of a pump packet. The packet is only
+    accepted if exactly one combination passes; otherwise, or if there are
+    too many invalid symbols, InvalidPacketReceived is raised.
+    """
+    data, symbols, errors = klass.decode_with_errors(buf)
+
+    if (symbols % 2) != 0:
+      raise InvalidPacketReceived("Error decoding FourBySix packet - odd number of symbols (%d)" % symbols)
+
+    if not errors:
+      return data
+
+    if len(errors) > max_errors:
+      raise InvalidPacketReceived("Error decoding FourBySix packet - %d invalid symbols at offsets %s, can correct at most %d" % (len(errors), errors, max_errors))
+
+    choices = [ ]
+    for offset in errors:
+      word = klass.symbol_at(buf, offset)
+      distances = [ bin(word ^ code).count('1') for code in klass.CODES ]
+      nearest = min(distances)
+      choices.append([ (offset, nibble) for nibble, distance in enumerate(distances) if distance == nearest ])
+
+    matches = [ ]
+    for candidate in itertools.product(*choices):
+      trial = bytearray(data)
+      for offset, nibble in candidate:
+        # The nibble for an invalid symbol was left as zero
+        if offset & 1:
+          trial[offset >> 1] |= nibble
+        else:
+          trial[offset >> 1] |= nibble << 4
+      if check(trial):
+        matches.append(trial)
+
+    if len(matches) != 1:
+      raise InvalidPacketReceived("Error decoding FourBySix packet - invalid symbols at offsets %s, %d corrections passed the check" % (errors, len(matches)))
+
+    return matches[0]
+
+class FourBySixDecoder (object):
+  """
+  Incremental FourBySix decoder. Chunks can be fed in as they arrive from
+  the radio, and decoding stops at the 000000 terminator, so the work
+  overlaps with the rest of the transfer instead of waiting for it.
+  """
+  def __init__ (self):
+    self.reset( )
+
+  def reset (self):
+    self.data = bytearray( )
+    self.errors = [ ]
+    self.symbols = 0
+    self.done = False
+    # The high nibble of a byte still waiting for its low nibble
+    self.pending = None
+    self._acc = 0
+    self._bits = 0
+
+  def feed (self, chunk):
+    """
+    Decode another chunk, returning the bytes it completed. Anything fed in
+    after the terminator is ignored.
+    """
+    start = len(self.data)
+    if self.done:
+      return bytearray( )
+
+    table = FourBySix.DECODE_TABLE
+    data = self.data
+    acc = self._acc
+    bits = self._bits
+    for byte in chunk:
+      acc = (acc << 8) | byte
+      bits += 8
+      while bits >= 6:
+        bits -= 6
+        code = (acc >> bits) & 0x3f
+        if code == 0:
+          self.done = True
+          break
+        nibble = table[code]
+        if nibble is None:
+          self.errors.append(self.symbols)
+          nibble = 0
+        if self.pending is None:
+          self.pending = nibble
+        else:
+          data.append((self.pending << 4) | nibble)
+          self.pending = None
+        self.symbols += 1
+      if self.done:
+        break
+      acc &= (1 << bits) - 1
+
+    self._acc = acc
+    self._bits = bits
+    return data[start:]
+
+  def finish (self):
+    """
+    Returns the decoded data, raising InvalidPacketReceived in the same cases
+    as FourBySix.decode.
+    """
+    if self.errors:
+      raise InvalidPacketReceived("Error decoding FourBySix packet - invalid symbols at offsets %s" % self.errors)
+
+    if self.pending is not None:
+      raise InvalidPacketReceived("Error decoding FourBySix packet - odd number of symbols (%d)" % self.symbols)
+
+    return self.data
@@ -1,25 +1,95 @@
-# From https://github.com/bewest/decoding-carelink/blob/314406d5d6025321dbe1a7d48a202b608df41c30/decocare/fuser.py
-# This still has race conditions, but is better than nothing for the moment,
-# as not all other apps use lock files
+# Originally from https://github.com/bewest/decoding-carelink/blob/314406d5d6025321dbe1a7d48a202b608df41c30/decocare/fuser.py
+#
+# Works out whether a port is in use without forking fuser: the port is
+# locked with flock, and since not all other apps lock it, /proc is also
+# checked for other processes holding it open. The tty isn't put into
+# exclusive mode (TIOCEXCL), since that would fail other jobs' opens
+# instead of letting them wait their turn for the flock.
 
+import errno
 import os
 import sys
+import time
 from subprocess import Popen, PIPE
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# How often to retry while waiting for a port to come free
+POLL_INTERVAL = 0.05
+
+def _fuser_in_use (device):
+  pipe = Popen(['fuser', device], stdout=PIPE, stderr=PIPE)
+  stdout, stderr = pipe.communicate( )
+
+  # Seriously hacky: don't raise an error if it's our own process ID
+  stdout = stdout.strip()
+  return stdout not in ['', str(os.getpid())]
+
 def in_use (device):
+  """
+  Whether any other process has device open
+  """
   if 'windows' in sys.platform:
     # TODO: use Handle
     # http://stackoverflow.com/questions/18059798/windows-batch-equivalent-of-fuser-k-folder
     # https://technet.microsoft.com/en-us/sysinternals/bb896655
     return False
-  pipe = Popen(['fuser', device], stdout=PIPE, stderr=PIPE)
-  stdout, stderr = pipe.communicate( )
+  if not os.path.isdir('/proc/self/fd'):
+    return _fuser_in_use(device)
 
-  # Seriously hacky: don't raise an error if it's our own process ID
-  stdout = stdout.strip()
-  return stdout not in ['', str(os.getpid())]
+  target = os.path.realpath(device)
+  me = str(os.getpid())
+  for pid in os.listdir('/proc'):
+    if not pid.isdigit() or pid == me:
+      continue
+    fd_dir = os.path.join('/proc', pid, 'fd')
+    try:
+      fds = os.listdir(fd_dir)
+    except OSError:
+      # Gone, or not ours to look at
+      continue
+    for fd in fds:
+      try:
+        if os.readlink(os.path.join(fd_dir, fd)) == target:
+          return True
+      except OSError:
+        continue
+  return False
+
+def _flock (fd):
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return True
+  except IOError as e:
+    if e.errno in (errno.EAGAIN, errno.EACCES):
+      return False
+    raise
+
+def lock (device, fd=None, timeout=0, check_open_files=True):
+  """
+  Take exclusive use of device, which we have open as fd (if it has one).
+
+  Waits up to timeout seconds for the flock, and, with check_open_files,
+  for any other process to close the port. Returns False if it's still in
+  use after that.
+  """
+  deadline = time.time() + timeout
+  while True:
+    locked = fd is None or fcntl is None or _flock(fd)
+    if locked and not (check_open_files and in_use(device)):
+      return True
+    if locked and fd is not None and fcntl is not None:
+      # Someone who doesn't lock has it open; don't hold on to the lock
+      # while waiting for them
+      fcntl.flock(fd, fcntl.LOCK_UN)
+    if time.time() >= deadline:
+      return False
+    time.sleep(POLL_INTERVAL)
 
 if __name__ == '__main__':
-  from scan import scan
-  candidate = (sys.argv[1:2] or [scan( )]).pop( )
+  from link_builder import LinkBuilder
+  candidate = (sys.argv[1:2] or [LinkBuilder().scan( )]).pop( )
   print in_use(candidate)
@@ -1,7 +1,11 @@
 
 from decocare import session, lib, commands
-from .. packets.rf import Packet
+from .. packets.rf import Packet, LazyPacket, FrameTemplate
 from .. exceptions import InvalidPacketReceived, CommsException
+from .. import trace
+from .. timing import CommandTiming, timed
+from .. rtt import link_rtt
+from .. detect_radio_comms import DetectRadioComms
 
 import logging
 import time
@@ -11,17 +15,128 @@ from decocare import lib
 io  = logging.getLogger( )
 log = io.getChild(__name__)
 
+class FrameReassembler (object):
+  """
+  Collects the frames of a multi-frame response into a buffer preallocated
+  for the whole response, writing each one into its slot by frame number.
+  Frames are numbered from 1, and the last one has 0x80 set. Duplicates
+  are dropped, and missing( ) lists the frames that haven't arrived yet.
+  key identifies the command, and its params, the frames belong to.
+  """
+  FRAME_SIZE = 64
+  LAST_FRAME = 0x80
+
+  def __init__ (self, size, frame_size=FRAME_SIZE, key=None):
+    self.key = key
+    self.frame_size = frame_size
+    self.count = (size + frame_size - 1) // frame_size
+    self.buf = bytearray(self.count * frame_size)
+    self.received = [ False ] * self.count
+    self.last = None
+
+  def index (self, num):
+    index = (num & ~self.LAST_FRAME) - 1
+    if index < 0 or index >= self.count:
+      raise InvalidPacketReceived("Frame number %d is outside the expected %d frames" % (num & ~self.LAST_FRAME, self.count))
+    return index
+
+  def conflicts (self, num, payload):
+    """
+    Whether a frame already stored under num differs from this one
+    """
+    index = self.index(num)
+    if not self.received[index]:
+      return False
+    start = index * self.frame_size
+    chunk = payload[:self.frame_size]
+    last = bool(num & self.LAST_FRAME)
+    return self.buf[start:start + len(chunk)] != chunk or last != (self.last == index)
+
+  def add (self, num, payload):
+    """
+    Store a frame, returning False if it's a duplicate
+    """
+    index = self.index(num)
+    if self.received[index]:
+      return False
+
+    chunk = payload[:self.frame_size]
+    start = index * self.frame_size
+    self.buf[start:start + len(chunk)] = chunk
+    self.received[index] = True
+    if num & self.LAST_FRAME:
+      self.last = index
+    return True
+
+  def expected (self):
+    if self.last is None:
+      return self.count
+    return self.last + 1
+
+  def missing (self):
+    return [ index + 1 for index in range(self.expected( )) if not self.received[index] ]
+
+  def complete (self):
+    return all(self.received[:self.expected( )])
+
+  def data (self):
+    if self.last is None:
+      return self.buf
+    return self.buf[:self.expected( ) * self.frame_size]
+
 class Sender (object):
   STANDARD_RETRY_COUNT = 3
-  RETRY_BACKOFF = 1
+  ACK_RETRIES = 2
 
   sent_params = False
   def __init__ (self, link):
     self.link = link
+    # Listen timeouts and retry delays come from how long the pump has been
+    # taking to reply over this link
+    self.rtt = link_rtt(link)
+    # Where the time goes, for the command being sent. See timing
+    self.timing = CommandTiming( )
+    self.reset( )
+
+  # Clears what's kept about the command being sent, so the Sender can be
+  # used for another
+  def reset (self):
     self.frames = [ ]
+    # How many of frames stream has yielded
+    self.streamed = 0
+    self.reassembly = None
     self.ack_for_more_data = False
     self.received_ack = False
-
+    self.sent_params = False
+
+  # A frame with the one byte payload preludes and acks use
+  def fixed_frame (self, op):
+    return FrameTemplate.get(self.command.serial, op).assemble(bytearray([0x00]))
+
+  # Sends buf, and reads what comes back if listen, counting the bytes
+  def exchange (self, buf, listen=True, **kwargs):
+    sent = len(buf) * (kwargs.get('repetitions') or 1)
+    if not listen:
+      self.link.write(buf, **kwargs)
+      self.timing.sent(sent)
+      return
+    # Sent bytes are counted once the link has sent them: when it returns,
+    # or says the reply didn't come
+    try:
+      buf = self.link.write_and_read(buf, **kwargs)
+    except CommsException:
+      self.timing.sent(sent)
+      raise
+    self.timing.sent(sent)
+    self.timing.received(len(buf))
+    return buf
+
+  def receive (self, timeout):
+    buf = self.link.read(timeout=timeout)
+    self.timing.received(len(buf))
+    return buf
+
+  @timed('send_params')
   def send_params (self):
     command = self.command
     params = self.command.params
@@ -29,33 +144,68 @@ class Sender (object):
     missing = [ ]
     missing = bytearray([0x00]) * (64 - len(params))
     payload = payload + missing
-    pkt = Packet.fromCommand(command, payload=payload, serial=command.serial)
-    pkt = pkt.update(payload)
-    buf = pkt.assemble( )
+    buf = FrameTemplate.get(command.serial, command.code).assemble(payload)
     self.sent_params = True
     try:
-      buf = self.link.write_and_read(buf)
-      resp = Packet.fromBuffer(buf)
+      buf = self.exchange(buf)
+      resp = LazyPacket.fromBuffer(buf)
       self.respond(resp)
     except AttributeError:
-      self.link.write(buf)
+      self.exchange(buf, listen=False)
 
+  @timed('ack')
   def ack (self, listen=False):
-    null = bytearray([0x00])
-    pkt = Packet.fromCommand(self.command, payload=null, serial=self.command.serial)
-    pkt = pkt._replace(payload=null, op=0x06)
-    buf = pkt.assemble( )
+    buf = self.fixed_frame(0x06)
     if listen:
-      buf = self.link.write_and_read(buf, timeout=0.1)
-      return Packet.fromBuffer(buf)
+      buf = self.exchange(buf, timeout=self.rtt.timeout( ))
+      return LazyPacket.fromBuffer(buf)
     else:
-      self.link.write(buf)
+      self.exchange(buf, listen=False)
+
+  # Asks for the next frame of a multi-frame response, acking again when it
+  # doesn't come. That's all it takes if our ack was lost. If the frame was,
+  # any gap it leaves is filled in when the command is restarted, where
+  # repeats are checked against the frames already stored
+  def next_frame (self):
+    for attempt in range(self.ACK_RETRIES + 1):
+      try:
+        return self.ack(listen=True)
+      except CommsException as e:
+        if attempt == self.ACK_RETRIES:
+          raise
+        log.debug("No frame after ack - %s - acking again", e)
+
+  # What a command's reassembly is keyed on, for checking resumes
+  @staticmethod
+  def frames_key (command):
+    return (command.code, tuple(command.params or [ ]))
+
+  # Throws away the frames received so far, for when the pump's response
+  # has changed under them
+  def start_over (self):
+    self.frames = [ ]
+    self.streamed = 0
+    self.reassembly = None
 
   def unframe (self, resp):
-    if self.command.bytesPerRecord * self.command.maxRecords > 64:
+    size = self.command.bytesPerRecord * self.command.maxRecords
+    if size > FrameReassembler.FRAME_SIZE:
       self.ack_for_more_data = True
       num, payload = resp.payload[0], resp.payload[1:]
+      if self.reassembly is None:
+        self.reassembly = FrameReassembler(size, key=self.frames_key(self.command))
+      if self.reassembly.conflicts(num, payload):
+        self.start_over( )
+        raise InvalidPacketReceived("Frame %d differs from the copy received before, starting over" % (num & ~FrameReassembler.LAST_FRAME))
+      if not self.reassembly.add(num, payload):
+        log.debug("Dropping duplicate frame %d", num)
+        return
       self.frames.append((num, resp.payload))
+
+      # Hand the whole response to the command in one go once it's complete
+      if not self.reassembly.complete( ):
+        return
+      payload = self.reassembly.data( )
     else:
       self.ack_for_more_data = False
       payload = resp.payload[1:]
@@ -76,12 +226,14 @@ class Sender (object):
       elif resp.op == self.command.code:
         self.unframe(resp)
 
-  def wait_for_ack (self, timeout=.500):
-    link = self.link
+  @timed('wait_for_ack')
+  def wait_for_ack (self, timeout=None):
+    if timeout is None:
+      timeout = self.rtt.timeout( )
 
     while not self.done( ):
-      buf = link.read( timeout=timeout )
-      resp = Packet.fromBuffer(buf)
+      buf = self.receive(timeout)
+      resp = LazyPacket.fromBuffer(buf)
       if self.responds_to(resp):
         if resp.op == 0x06:
           return
@@ -89,36 +241,34 @@ class Sender (object):
   def responds_to (self, resp):
     return resp.valid and resp.serial == self.command.serial
 
+  @timed('wait_response')
   def wait_response (self):
-    link = self.link
-    buf = link.read( )
-    resp = Packet.fromBuffer(buf)
+    buf = self.receive(self.rtt.timeout( ))
+    resp = LazyPacket.fromBuffer(buf)
     if self.responds_to(resp):
       return resp
 
+  @timed('prelude')
   def prelude (self):
-    link = self.link
     command = self.command
-    log.debug("*** Sending prelude for command %d" % command.code)
+    log.debug("*** Sending prelude for command %d", command.code)
 
-    payload = bytearray([0])
-    self.pkt = Packet.fromCommand(command, payload=payload, serial=command.serial)
-    self.pkt = self.pkt.update(payload)
-    buf = self.pkt.assemble( )
+    buf = self.fixed_frame(command.code)
     try:
-      buf = self.link.write_and_read(buf)
-      resp = Packet.fromBuffer(buf)
+      buf = self.exchange(buf)
+      resp = LazyPacket.fromBuffer(buf)
       if self.responds_to(resp):
         if resp.op == 0x06:
           self.received_ack = True
         else:
           self.respond(resp)
     except AttributeError:
-      self.link.write(buf)
+      self.exchange(buf, listen=False)
 
+  @timed('upload')
   def upload (self):
     params = self.command.params
-    log.debug("len(params)  == %d" % len(params))
+    log.debug("len(params)  == %d", len(params))
 
     should_send = len(params) > 0
     if should_send:
@@ -130,19 +280,77 @@ class Sender (object):
     # This is a bit of a hack; would be nice if decocare explicitly supported a command reset
     self.command.data = bytearray()
     self.command.responded = False
+    # Frames already received are kept, and their repeats dropped, so a
+    # download picks up where it failed
+    frames, streamed, reassembly = self.frames, self.streamed, self.reassembly
+    self.reset( )
+    self.frames, self.streamed, self.reassembly = frames, streamed, reassembly
+
+  def new_frames (self):
+    while self.streamed < len(self.frames):
+      num, payload = self.frames[self.streamed]
+      self.streamed += 1
+      yield num & ~FrameReassembler.LAST_FRAME, payload[1:]
 
   def __call__ (self, command):
+    try:
+      for frame in self.stream(command):
+        pass
+    except CommsException as e:
+      log.error("%s", e)
+      return None
+    return command
+
+  # A new CommandTiming for command, left on it as command.timing
+  def start_timing (self, command):
+    self.timing = command.timing = CommandTiming(command.code)
+    return self.timing
+
+  def stream (self, command, resume=None):
+    """
+    Send command, yielding (frame number, data) for each frame of a
+    multi-frame response as soon as it arrives, rather than once the whole
+    response is in. Frames aren't yielded twice, even when a retry has the
+    pump send them again - unless one it sends again has changed, when all
+    of them are thrown away and yielded again from frame 1.
+
+    resume, the reassembly of an earlier attempt at the same command, picks
+    the download up from there: only frames it's missing are yielded. It
+    must have the same code and params, or ValueError is raised. Raises
+    CommsException if it runs out of retries.
+    """
     self.command = command
+    self.start_timing(command)
+    try:
+      for frame in self.attempts(resume):
+        yield frame
+    finally:
+      self.timing.finish( )
+
+  def attempts (self, resume):
+    command = self.command
+    self.reset( )
+    if resume is not None:
+      if resume.key != self.frames_key(command):
+        raise ValueError("Can't resume command %d with params %s from frames of %s" % (command.code, list(command.params or [ ]), resume.key))
+      self.reassembly = resume
+      if resume.complete( ):
+        command.respond(resume.data( ))
+        return
 
     for retry_count in range(self.STANDARD_RETRY_COUNT):
       try:
         self.prelude()
+        for frame in self.new_frames( ):
+          yield frame
         self.upload()
+        for frame in self.new_frames( ):
+          yield frame
 
         while not self.done( ):
           if self.ack_for_more_data:
             try:
-              resp = self.ack(listen=True)
+              resp = self.next_frame( )
             except AttributeError:
               self.ack(listen=False)
               resp = self.wait_response( )
@@ -150,27 +358,35 @@ class Sender (object):
             resp = self.wait_response( )
           if resp:
             self.respond(resp)
+            for frame in self.new_frames( ):
+              yield frame
 
-        return command
+        return
       except InvalidPacketReceived as e:
         log.error("Invalid Packet Received - '%s' - retrying: %s of %s" % (e, retry_count+1, self.STANDARD_RETRY_COUNT))
         self.restart_command()
       except CommsException as e:
         log.error("Timed out or other comms error - %s - retrying: %s of %s" % (e, retry_count+1, self.STANDARD_RETRY_COUNT))
         self.restart_command()
-      time.sleep(self.RETRY_BACKOFF * retry_count)
+      self.timing.retry( )
+      with self.timing.phase('retry_delay'):
+        time.sleep(self.rtt.retry_delay(retry_count))
+
+    raise CommsException("Giving up on command %d after %d tries" % (command.code, self.STANDARD_RETRY_COUNT))
 
 class Repeater (Sender):
 
   def __call__ (self, command, repetitions=None, ack_wait_seconds=None):
     self.command = command
+    timing = self.start_timing(command)
 
     start = time.time()
     pkt = Packet.fromCommand(self.command, serial=self.command.serial)
     buf = pkt.assemble( )
-    log.debug('Sending repeated message %s' % (str(buf).encode('hex')))
+    log.debug('Sending repeated message %s', trace.LazyHex(buf))
 
-    self.link.write(buf, repetitions=repetitions)
+    with timing.phase('repeat'):
+      self.exchange(buf, listen=False, repetitions=repetitions)
 
     # The radio takes a while to send all the packets, so wait for a bit before
     # trying to talk to the radio, otherwise we can interrupt it.
@@ -179,7 +395,8 @@ class Repeater (Sender):
     # testing, which shows that it takes 8.04 seconds to send 500 packets
     # (8.04/500 =~ 0.016 packets per second).
     # We don't want to miss the reply, so take off a bit:
-    time.sleep((repetitions * 0.016) - 2.2)
+    with timing.phase('repeat_wait'):
+      time.sleep((repetitions * 0.016) - 2.2)
 
     # Sometimes the first packet received will be mangled by the simultaneous
     # transmission of a CGMS and the pump. We thus retry on invalid packets
@@ -189,41 +406,223 @@ class Repeater (Sender):
     while (time.time() <= start + ack_wait_seconds):
       try:
         self.wait_for_ack()
+        timing.finish( )
         return True
       except CommsException, InvalidPacketReceived:
         log.error("Response not received - retrying at %s" % time.time)
 
+    timing.finish( )
     return False
 
+class Waker (Sender):
+  """
+  Sends the wakeup in short bursts with SEND_AND_LISTEN, listening for the
+  pump's ack after each one, so a pump that wakes early isn't kept waiting
+  for the rest of the train. Returns the number of packets sent before the
+  ack, or None if the pump didn't answer.
+  """
+  # Listen for at least this long after each burst
+  LISTEN_TIMEOUT = 0.15
+
+  def __call__ (self, command, repetitions=250, burst=50):
+    self.command = command
+    timing = self.start_timing(command)
+    buf = Packet.fromCommand(self.command, serial=self.command.serial).assemble( )
+    listen = max(self.rtt.timeout( ), self.LISTEN_TIMEOUT)
+
+    sent = 0
+    while sent < repetitions:
+      count = min(burst, repetitions - sent)
+      sent += count
+      try:
+        with timing.phase('wake_burst'):
+          resp = LazyPacket.fromBuffer(self.exchange(buf, repetitions=count, timeout=listen))
+      except (CommsException, InvalidPacketReceived) as e:
+        log.debug("No ack after %d wakeup packets - %s", sent, e)
+        continue
+      if self.responds_to(resp) and resp.op == 0x06:
+        timing.finish( )
+        return sent
+    timing.finish( )
+    return None
+
 class Pump (session.Pump):
   STANDARD_RETRY_COUNT = 3
   STANDARD_RETRY_BACKOFF = 1
 
-  def __init__ (self, link, serial):
+  # What the last stream( ) received, for resuming it
+  reassembly = None
+
+  # Wakeups go out in bursts of WAKE_BURST packets, up to WAKE_BURST_LIMIT
+  # of them, before falling back to one train of WAKE_REPETITIONS
+  WAKE_BURST = 50
+  WAKE_BURST_LIMIT = 250
+  WAKE_REPETITIONS = 500
+
+  # Before waking a pump that wake_state doesn't know to be awake, see if
+  # it answers a model query, and then, for up to LISTEN_BEFORE_WAKE
+  # seconds, listen for it talking to something else
+  PROBE_BEFORE_WAKE = True
+  LISTEN_BEFORE_WAKE = 0
+
+  # How many packets the last wakeup took, 0 if the pump was already awake,
+  # or None if it wasn't acked
+  wake_repetitions = None
+
+  # wake_state, a WakeState, lets power_control skip waking a pump that
+  # an earlier run already woke, until a command to it fails. responses, a ResponseCache, lets execute
+  # answer reads that hardly ever change without the radio
+  def __init__ (self, link, serial, wake_state=None, responses=None):
     self.link = link
     self.serial = serial
+    self.wake_state = wake_state
+    self.responses = responses
+
+  def radio (self):
+    return getattr(self.link, 'device', None)
+
+  def check_awake (self):
+    """
+    Whether the pump answers a single model query, with no retries
+    """
+    link = self.link
+    buf = FrameTemplate.get(self.serial, commands.ReadPumpModel.code).assemble(bytearray([0]))
+    try:
+      if hasattr(link, 'write_and_read'):
+        buf = link.write_and_read(buf)
+      else:
+        link.write(buf)
+        buf = link.read( )
+      resp = LazyPacket.fromBuffer(buf)
+    except (CommsException, InvalidPacketReceived) as e:
+      log.debug("Pump %s didn't answer - %s", self.serial, e)
+      return False
+    return resp.serial == self.serial and resp.op == commands.ReadPumpModel.code
+
+  def already_awake (self):
+    """
+    Whether the pump is awake without waking it: wake_state has it woken
+    and not yet run out, or it answers a model query, or, with
+    LISTEN_BEFORE_WAKE, is heard talking to something else and then
+    answers
+    """
+    state = self.wake_state
+    if state is not None and state.awake(self.serial, self.radio( )):
+      log.info('Pump %s was woken earlier and should still be awake', self.serial)
+      return True
+    if self.PROBE_BEFORE_WAKE and self.check_awake( ):
+      log.info('Pump %s is already awake', self.serial)
+      return True
+
+    if self.LISTEN_BEFORE_WAKE > 0:
+      detector = DetectRadioComms(link=self.link, wait_for=self.LISTEN_BEFORE_WAKE, ignore_wake=True, serial=self.serial)
+      if detector.detect( ) and self.check_awake( ):
+        log.info('Pump %s is awake and talking to something else', self.serial)
+        return True
+    return False
 
   def power_control (self, minutes=None):
     """ Control Pumping """
     log.info('BEGIN POWER CONTROL %s' % self.serial)
     self.command = commands.PowerControl(**dict(minutes=minutes, serial=self.serial))
-    repeater = Repeater(self.link)
 
-    status = repeater(self.command, repetitions=500, ack_wait_seconds=20)
+    if self.already_awake( ):
+      self.wake_repetitions = 0
+      return True
 
+    self.wake_repetitions = None
+    # Links that can't listen straight after sending only get the long train
+    if hasattr(self.link, 'write_and_read'):
+      waker = Waker(self.link)
+      self.wake_repetitions = waker(self.command, repetitions=self.WAKE_BURST_LIMIT, burst=self.WAKE_BURST)
+
+    if self.wake_repetitions is None:
+      repeater = Repeater(self.link)
+      status = repeater(self.command, repetitions=self.WAKE_REPETITIONS, ack_wait_seconds=20)
+      if status:
+        self.wake_repetitions = self.WAKE_REPETITIONS
+
+    log.info('Pump %s wakeup took %s packets', self.serial, self.wake_repetitions)
+    if self.wake_state is not None and self.wake_repetitions is not None:
+      self.wake_state.record(self.serial, self.radio( ), self.command.params[1])
     return True
-    if status:
-      return True
-    else:
-      raise CommsException("No acknowledgement from pump on wakeup. Is it out of range or is the battery too low?")
 
-  def execute (self, command):
+  # sender, if given, is used instead of a new Sender. See execute_many
+  def execute (self, command, sender=None):
     command.serial = self.serial
 
+    responses = self.responses
+    if responses is not None:
+      if responses.load(self.serial, command):
+        log.info('Using cached response to command %d from %s', command.code, self.serial)
+        command.timing = CommandTiming(command.code, cached=True)
+        command.timing.finish( )
+        return command
+      # Before sending, in case the write goes through but its ack is lost
+      responses.invalidate(self.serial, command)
+
     for retry_count in range(self.STANDARD_RETRY_COUNT):
       try:
-          sender = Sender(self.link)
-          return sender(command)
+          sender = sender or Sender(self.link)
+          result = sender(command)
+          if result is None:
+            self.forget_wakeup( )
+          elif responses is not None:
+            responses.store(self.serial, command)
+          return result
       except (CommsException, AssertionError) as e:
           log.error("Timed out or other comms exception - %s - retrying: %s of %s" % (e, retry_count, self.STANDARD_RETRY_COUNT))
-          time.sleep(self.RETRY_BACKOFF * retry_count)
+          time.sleep(link_rtt(self.link).retry_delay(retry_count))
+    self.forget_wakeup( )
+
+  # The pump may have gone back to sleep - after a battery change, say - so
+  # the next power_control wakes it instead of going by wake_state
+  def forget_wakeup (self):
+    state = self.wake_state
+    if state is not None and state.expiry(self.serial, self.radio( )) is not None:
+      log.info('Forgetting the wakeup of pump %s, which stopped answering', self.serial)
+      state.forget(self.serial, self.radio( ))
+
+  def execute_many (self, commands):
+    """
+    Run several commands back to back over one Sender, yielding what
+    execute would return for each as soon as it's done. When one gets no
+    answer, the pump is sent a single model query, and if that goes
+    unanswered too, the rest are given up on - yielding None for each -
+    rather than each spending its own retries on a pump that's gone.
+    """
+    sender = Sender(self.link)
+    commands = list(commands)
+    for index, command in enumerate(commands):
+      result = self.execute(command, sender=sender)
+      yield result
+      remaining = commands[index + 1:]
+      if result is None and remaining and not self.check_awake( ):
+        log.error("Pump %s stopped answering, skipping %d more commands", self.serial, len(remaining))
+        for command in remaining:
+          command.serial = self.serial
+          yield None
+        return
+
+  def stream (self, command, resume=None):
+    """
+    Send command, yielding each frame of its response as it arrives. See
+    Sender.stream. Whatever was received, even if the download failed or
+    was stopped early, is left in self.reassembly for passing back as
+    resume.
+    """
+    command.serial = self.serial
+    sender = Sender(self.link)
+    try:
+      for frame in sender.stream(command, resume=resume):
+        yield frame
+    finally:
+      self.reassembly = sender.reassembly
+
+  def stream_history (self, page, resume=None):
+    """
+    Download a history page, yielding (frame number, data) for each of its
+    64 byte frames as it arrives. Stop iterating once you reach records
+    you already have.
+    """
+    return self.stream(commands.ReadHistoryData(page=page), resume=resume)
@@ -1,18 +1,26 @@
 from mmeowlink.exceptions import UnknownLinkType
 
+from mmeowlink.discovery import Discovery
 from mmeowlink.vendors.mmcommander_link import MMCommanderLink
 from mmeowlink.vendors.subg_rfspy_link import SubgRfspyLink
-import glob
 
 class LinkBuilder():
-  def scan (self):
-    candidate = '/dev/serial/by-id/usb-*subg_rfspy*'
-    results = glob.glob(candidate)
-    return (results[0:1] or ['']).pop( )
-  def build(self, radio_type, port):
+  def __init__ (self, discovery=None):
+    self.discovery = discovery or Discovery( )
+
+  # Port of the first radio found, of radio_type if given. See Discovery
+  def scan (self, radio_type=None, refresh=False):
+    port, found_type = self.discovery.scan(radio_type, refresh=refresh)
+    return port or ''
+
+  # radio_type None means use whatever radio is on port.
+  # max_symbol_corrections only applies to subg_rfspy. See SubgRfspyLink
+  def build(self, radio_type, port, max_symbol_corrections=0):
+    if radio_type is None:
+      radio_type = self.discovery.radio_type(port)
     if radio_type == 'mmcommander':
       return MMCommanderLink(port)
     elif radio_type == 'subg_rfspy':
-      return SubgRfspyLink(port)
+      return SubgRfspyLink(port, max_symbol_corrections=max_symbol_corrections)
     else:
       raise UnknownLinkType("Unknown radio type '%s' - check parameters" % radio_type)
@@ -14,6 +14,47 @@ _Packet = namedtuple('Packet', [
   ])
 
 
+class FrameTemplate (object):
+  """
+  The type + serial + op prefix of an outgoing frame, assembled once along
+  with the CRC8 state after it. Building a frame from a template is then
+  just appending the payload and finishing the CRC.
+
+  Templates are cached per (serial, op), so use FrameTemplate.get( ) rather
+  than constructing them directly.
+  """
+  __slots__ = ('prefix', 'prefix_crc')
+
+  _cache = { }
+
+  def __init__ (self, serial, op, rftype=0xA7):
+    prefix = bytearray([rftype])
+    prefix.extend(serial.decode('hex'))
+    prefix.append(op)
+    self.prefix = prefix
+    self.prefix_crc = lib.CRC8.compute(prefix)
+
+  @classmethod
+  def get (klass, serial, op, rftype=0xA7):
+    key = (serial, op, rftype)
+    template = klass._cache.get(key)
+    if template is None:
+      template = klass._cache[key] = klass(serial, op, rftype=rftype)
+    return template
+
+  def crc (self, payload):
+    lookup = lib.CRC8.lookup
+    result = self.prefix_crc
+    for byte in payload:
+      result = lookup[result ^ byte]
+    return result
+
+  def assemble (self, payload):
+    buf = self.prefix + payload
+    buf.append(self.crc(payload))
+    return buf
+
+
 class Packet (_Packet):
   @classmethod
   def fromCommand (klass, command, payload=bytearray([0x00]), serial=None,
@@ -47,13 +88,8 @@ class Packet (_Packet):
     # self.crc =
     return pkt
   def assemble (self):
-    pkt = self.update( )
-    buf = bytearray([self.type])
-    buf.extend(pkt.serial.decode('hex'))
-    buf.extend(bytearray([pkt.op]))
-    buf.extend(pkt.payload)
-    buf.extend(bytearray([pkt.crc]))
-    return buf
+    template = FrameTemplate.get(self.serial, self.op, rftype=self.type)
+    return template.assemble(self.payload)
 
   def oneliner (self):
     kwds = dict(head=str(bytearray([self.op])).encode('hex')
@@ -62,54 +98,92 @@ class Packet (_Packet):
          )
     return """{head}{serial}{tail}""".format(**kwds)
   def genCRC (self):
-    buf = bytearray([self.type])
-    buf.extend(self.serial.decode('hex'))
-    buf.extend(bytearray([self.op]))
-    buf.extend(self.payload)
-    calculated = lib.CRC8.compute(buf)
-    return calculated
+    template = FrameTemplate.get(self.serial, self.op, rftype=self.type)
+    return template.crc(self.payload)
 
   @classmethod
   def fromBuffer (klass, buf, stamp=None, timezone=None, chan=None):
-    stamp = stamp or time.time( )
-    # dt = datetime.fromtimestamp(stamp).replace(tzinfo=self.args.timezone)
-    dt = datetime.fromtimestamp(stamp).replace(tzinfo=timezone)
-    msg = lib.hexdump(buf)
-
-    # head = buf[0:2]
-    rfpacket = buf
-    rftype   = buf[0]
-    serial   = str(rfpacket[1:4]).encode('hex')
-    command  = None
-    payload  = None
-    crc      = None
-    valid    = False
-
-    if serial and len(rfpacket) > 5:
-      rftype   = rfpacket[0]
-      command  = rfpacket[4]
-      payload  = rfpacket[5:-1]
-      crc = int(rfpacket[-1])
-      calculated = lib.CRC8.compute(rfpacket[:-1])
-      valid = calculated == crc
-
-    if not valid:
-      raise InvalidPacketReceived
+    """
+    A received packet, as a LazyPacket: the fields are the same, but are
+    only worked out when they're asked for
+    """
+    return LazyPacket.fromBuffer(buf, stamp=stamp, timezone=timezone, chan=chan)
 
-    record = dict(date=stamp * 1000
-           , dateString=dt.isoformat( )
-           , type = rftype
-           , serial = serial
-           , op = command
-           , payload = payload
-           , payload_hex = str(payload).encode('hex')
-           , crc = crc
-           , valid = valid
-           , chan = chan
-           # , rfpacket=str(rfpacket).encode('hex')
-           # , head=str(head).encode('hex')
-           # , op=str(rfpacket[0:1]).encode('hex')
-           # , decocare_hex=msg
-           )
-    pkt = klass(**record)
+
+class LazyPacket (object):
+  """
+  Compact, read-only view over a received packet buffer. Header fields are
+  read from the buffer when asked for, and dateString/payload_hex are only
+  formatted on demand, so checking op and serial costs next to nothing.
+  as_packet( ) gives the equivalent Packet namedtuple, and Packet's other
+  methods, such as assemble( ) and _asdict( ), work through it.
+  """
+  __slots__ = ('buf', 'stamp', 'timezone', 'chan', '_serial', '_valid')
+
+  def __init__ (self, buf, stamp=None, timezone=None, chan=None):
+    self.buf = buf
+    self.stamp = stamp or time.time( )
+    self.timezone = timezone
+    self.chan = chan
+    self._serial = None
+    self._valid = None
+
+  @classmethod
+  def fromBuffer (klass, buf, stamp=None, timezone=None, chan=None):
+    pkt = klass(buf, stamp=stamp, timezone=timezone, chan=chan)
+    if not pkt.valid:
+      raise InvalidPacketReceived
     return pkt
+
+  @property
+  def type (self):
+    return self.buf[0]
+
+  @property
+  def serial (self):
+    if self._serial is None:
+      self._serial = str(self.buf[1:4]).encode('hex')
+    return self._serial
+
+  @property
+  def op (self):
+    if len(self.buf) > 5:
+      return self.buf[4]
+
+  @property
+  def payload (self):
+    if len(self.buf) > 5:
+      return self.buf[5:-1]
+
+  @property
+  def crc (self):
+    if len(self.buf) > 5:
+      return int(self.buf[-1])
+
+  @property
+  def valid (self):
+    if self._valid is None:
+      buf = self.buf
+      self._valid = len(buf) > 5 and lib.CRC8.compute(buf[:-1]) == buf[-1]
+    return self._valid
+
+  @property
+  def date (self):
+    return self.stamp * 1000
+
+  @property
+  def dateString (self):
+    dt = datetime.fromtimestamp(self.stamp).replace(tzinfo=self.timezone)
+    return dt.isoformat( )
+
+  @property
+  def payload_hex (self):
+    return str(self.payload).encode('hex')
+
+  def as_packet (self):
+    return Packet(**dict((field, getattr(self, field)) for field in Packet._fields))
+
+  def __getattr__ (self, name):
+    if name.startswith('__') or name in self.__slots__:
+      raise AttributeError(name)
+    return getattr(self.as_packet( ), name)
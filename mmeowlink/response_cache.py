@@ -0,0 +1,109 @@
+"""
+Keeps the responses to pump reads that hardly ever change - model,
+settings, basal profiles, targets, ratios and the like - so they needn't
+be fetched over the radio every cycle. Kept per pump serial, command code
+and params in ~/.mmeowlink/responses.json, each for its command's TTL.
+Commands that change the pump clear its responses. See Pump.execute
+"""
+
+import logging
+import time
+
+from cache import cache_path, load_json, locked, save_json
+
+io  = logging.getLogger( )
+log = io.getChild(__name__)
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+
+# Seconds to keep the response to each command code for. Only these are
+# cached
+TTLS = {
+  0x8d: 24 * HOUR,    # ReadPumpModel
+  0x74: 24 * HOUR,    # ReadFirmwareVersion
+  0x71: 24 * HOUR,    # ReadPumpID
+  0x88: HOUR,         # ReadCarbUnits
+  0x89: HOUR,         # ReadBGUnits
+  0x8a: HOUR,         # ReadCarbRatios
+  0x8b: HOUR,         # ReadInsulinSensitivities
+  0x8c: HOUR,         # ReadBGTargets
+  0x9f: HOUR,         # ReadBGTargets515
+  0x91: HOUR,         # ReadSettings512
+  0xc0: HOUR,         # ReadSettings
+  0x92: HOUR,         # ReadProfile_STD512
+  0x93: HOUR,         # ReadProfile_A512
+  0x94: HOUR,         # ReadProfile_B512
+}
+
+# Commands after which nothing cached for the pump can be trusted
+WRITES = set([
+  0x40,   # SetRTC
+  0x42,   # Bolus
+  0x4a,   # SelectBasalProfile
+  0x4c,   # TempBasal
+  0x4d,   # SetSuspend
+  0x4e,   # SetAutoOff
+  0x4f,   # SetEnabledEasyBolus
+  0x5b,   # KeypadPush
+  0x68,   # SetBasalType
+  0x69,   # TempBasalPercent
+  0xf2,   # ChangeCaptureEventEnable
+])
+
+class ResponseCache (object):
+  FILE = 'responses.json'
+
+  def __init__ (self, path=None, ttls=None):
+    self.path = path or cache_path(self.FILE)
+    self.ttls = TTLS if ttls is None else ttls
+
+  @staticmethod
+  def key (serial, command):
+    params = bytearray(command.params or [ ])
+    return '%s:%02x:%s' % (serial, command.code, str(params).encode('hex'))
+
+  def cacheable (self, command):
+    return command.code in self.ttls
+
+  def load (self, serial, command, now=None):
+    """
+    Fill in command's response from the cache. Returns whether it could
+    """
+    if not self.cacheable(command):
+      return False
+    entry = load_json(self.path, { }).get(self.key(serial, command))
+    if entry is None or entry['expires'] <= (now or time.time()):
+      return False
+    command.respond(bytearray(entry['data'].decode('hex')))
+    return True
+
+  def store (self, serial, command):
+    if not self.cacheable(command):
+      return
+    entry = dict(expires=time.time() + self.ttls[command.code], data=str(command.data).encode('hex'))
+    self.update(lambda state: state.__setitem__(self.key(serial, command), entry))
+
+  def invalidate (self, serial, command):
+    """
+    Forget serial's responses if command might change them
+    """
+    if command.code in WRITES:
+      self.clear(serial)
+
+  def clear (self, serial):
+    log.debug("Forgetting cached responses from %s", serial)
+    prefix = '%s:' % serial
+    def drop (state):
+      for key in [ key for key in state if key.startswith(prefix) ]:
+        del state[key]
+    self.update(drop)
+
+  def update (self, change):
+    now = time.time()
+    with locked(self.path):
+      state = load_json(self.path, { })
+      # Drop responses that have run out
+      state = dict((key, entry) for key, entry in state.items() if entry['expires'] > now)
+      change(state)
+      save_json(self.path, state)
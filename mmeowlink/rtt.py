@@ -0,0 +1,83 @@
+"""
+Round trip time estimation for pump exchanges, the way TCP does it
+(RFC 6298): a smoothed round trip time and its mean deviation, updated
+from each reply, give a timeout that's as short as the pump's replies
+allow. It's kept between a floor and a ceiling, and every timeout doubles
+it, from at least the floor, until the next reply comes in.
+"""
+
+class RttEstimator (object):
+  # Gains for the smoothed round trip time and its deviation
+  ALPHA = 1 / 8.0
+  BETA = 1 / 4.0
+  # How many deviations above the smoothed round trip time to wait
+  K = 4
+
+  INITIAL = 0.5
+  # About the quickest a pump turns a reply around
+  FLOOR = 0.1
+  CEILING = 1.0
+
+  def __init__ (self, initial=INITIAL, floor=FLOOR, ceiling=CEILING):
+    self.initial = initial
+    self.floor = floor
+    self.ceiling = ceiling
+    self.reset( )
+
+  def reset (self):
+    self.srtt = None
+    self.rttvar = None
+    self.backoff = 1
+    self.samples = 0
+
+  def clamp (self, seconds):
+    return min(max(seconds, self.floor), self.ceiling)
+
+  def observe (self, rtt):
+    """
+    Record the time a reply took to come back
+    """
+    if self.srtt is None:
+      self.srtt = rtt
+      self.rttvar = rtt / 2.0
+    else:
+      self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+      self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+    self.backoff = 1
+    self.samples += 1
+
+  def timed_out (self):
+    """
+    Record a reply that never came, lengthening the next timeout
+    """
+    if self.timeout( ) < self.ceiling:
+      self.backoff *= 2
+
+  def timeout (self):
+    """
+    How long to listen for a reply
+    """
+    if self.srtt is None:
+      base = self.initial
+    else:
+      base = self.srtt + self.K * self.rttvar
+    # Backing off from below the floor would take a doubling or two to
+    # get anywhere
+    return min(max(base, self.floor) * self.backoff, self.ceiling)
+
+  def retry_delay (self, attempt):
+    """
+    How long to wait before retry number attempt (counting from 0)
+    """
+    if attempt <= 0:
+      return 0
+    return self.clamp(self.timeout( ) * attempt)
+
+def link_rtt (link):
+  """
+  The estimator a link keeps, or a new one for links without
+  """
+  rtt = getattr(link, 'rtt', None)
+  if rtt is None:
+    rtt = RttEstimator( )
+  return rtt
@@ -0,0 +1,185 @@
+"""
+Where the time goes in a pump command.
+
+Sender, Repeater and Waker time each phase of a command - prelude,
+upload, send_params, wait_for_ack, ack, wait_response, retry_delay and
+so on - on the monotonic clock, along with the bytes sent and received
+over the air, timeouts and CRC failures. The CommandTiming for the last
+run of a command is left on it as command.timing, and summary( ) gives
+totals per phase:
+
+  pump.execute(command)
+  print command.timing.json( )
+
+Responses answered from a ResponseCache get a timing with no phases,
+marked cached.
+
+Hooks see every phase as it ends, and each command as it finishes, as
+hook(timing, phase), with phase None for the command:
+
+  timing.add_hook(lambda timing, phase: ...)
+"""
+
+import functools
+import json
+import logging
+import time
+
+from exceptions import CommsException, InvalidPacketReceived
+
+io  = logging.getLogger( )
+log = io.getChild(__name__)
+
+try:
+  from time import monotonic
+except ImportError:
+  # Python 2 has no monotonic clock, so ask libc for CLOCK_MONOTONIC, or
+  # use the wall clock where that can't be had
+  import ctypes
+  import ctypes.util
+
+  CLOCK_MONOTONIC = 1   # As on Linux
+
+  class _timespec (ctypes.Structure):
+    _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+
+  try:
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c')).clock_gettime
+    _clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(_timespec) ]
+  except (OSError, AttributeError, TypeError):
+    _clock_gettime = None
+
+  def monotonic ( ):
+    spec = _timespec( )
+    if _clock_gettime is None or _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+      return time.time( )
+    return spec.tv_sec + spec.tv_nsec * 1e-9
+
+_hooks = [ ]
+
+def add_hook (hook):
+  _hooks.append(hook)
+
+def remove_hook (hook):
+  _hooks.remove(hook)
+
+def _call_hooks (timing, phase):
+  for hook in _hooks:
+    try:
+      hook(timing, phase)
+    except Exception as e:
+      log.error("Timing hook failed - %s", e)
+
+class Phase (object):
+  __slots__ = ('name', 'attempt', 'start', 'end', 'sent', 'received', 'timeouts', 'crc_failures')
+
+  def __init__ (self, name, attempt=0):
+    self.name = name
+    self.attempt = attempt
+    self.start = monotonic( )
+    self.end = None
+    self.sent = 0
+    self.received = 0
+    self.timeouts = 0
+    self.crc_failures = 0
+
+  @property
+  def seconds (self):
+    return (self.end or monotonic( )) - self.start
+
+  def as_dict (self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+class CommandTiming (object):
+  """
+  The phases of one command, in the order they ended. Phases can nest -
+  upload waits for an ack, say - and bytes and errors count towards the
+  innermost one only, so totals add up.
+  """
+  def __init__ (self, code=None, cached=False):
+    self.code = code
+    self.cached = cached
+    self.start = monotonic( )
+    self.end = None
+    self.retries = 0
+    self.phases = [ ]
+    self.stack = [ ]
+    self.last_error = None
+
+  def phase (self, name):
+    return _Timed(self, name)
+
+  def sent (self, count):
+    if self.stack:
+      self.stack[-1].sent += count
+
+  def received (self, count):
+    if self.stack:
+      self.stack[-1].received += count
+
+  def retry (self):
+    self.retries += 1
+
+  def finish (self):
+    if self.end is None:
+      self.end = monotonic( )
+      _call_hooks(self, None)
+
+  @property
+  def seconds (self):
+    return (self.end or monotonic( )) - self.start
+
+  def summary (self):
+    """
+    Totals for the command and for each phase, by name
+    """
+    phases = { }
+    for phase in self.phases:
+      totals = phases.setdefault(phase.name, dict(count=0, seconds=0, sent=0, received=0, timeouts=0, crc_failures=0))
+      totals['count'] += 1
+      totals['seconds'] += phase.seconds
+      for field in ('sent', 'received', 'timeouts', 'crc_failures'):
+        totals[field] += getattr(phase, field)
+    result = dict(code=self.code, cached=self.cached, seconds=self.seconds, retries=self.retries, phases=phases)
+    for field in ('sent', 'received', 'timeouts', 'crc_failures'):
+      result[field] = sum(getattr(phase, field) for phase in self.phases)
+    return result
+
+  def json (self):
+    return json.dumps(self.summary( ), sort_keys=True)
+
+class _Timed (object):
+  def __init__ (self, timing, name):
+    self.timing = timing
+    self.phase = Phase(name, attempt=timing.retries)
+
+  def __enter__ (self):
+    self.timing.stack.append(self.phase)
+    return self.phase
+
+  def __exit__ (self, kind, error, traceback):
+    timing, phase = self.timing, self.phase
+    phase.end = monotonic( )
+    timing.stack.pop( )
+    # Only the phase the error came from counts it, not those it passes through
+    if kind is not None and (error is None or error is not timing.last_error):
+      timing.last_error = error
+      if issubclass(kind, CommsException):
+        phase.timeouts += 1
+      elif issubclass(kind, InvalidPacketReceived):
+        phase.crc_failures += 1
+    timing.phases.append(phase)
+    _call_hooks(timing, phase)
+    return False
+
+def timed (name):
+  """
+  Decorator running a method as phase name of self.timing
+  """
+  def decorate (method):
+    @functools.wraps(method)
+    def wrapper (self, *args, **kwargs):
+      with self.timing.phase(name):
+        return method(self, *args, **kwargs)
+    return wrapper
+  return decorate
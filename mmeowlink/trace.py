@@ -0,0 +1,98 @@
+"""
+Tracing for the radio hot path.
+
+Frames are only hex formatted if the logger will actually emit them, and
+can also be recorded raw to a binary sink instead, which costs a struct
+pack and a write rather than any string formatting:
+
+  trace.set_sink(trace.BinaryTraceSink('/tmp/radio.trace'))
+  ...
+  for stamp, kind, data in trace.read_trace('/tmp/radio.trace'):
+    ...
+"""
+
+import logging
+import struct
+import time
+
+from decocare.lib import hexdump
+
+# Kinds of frame
+COMMAND = 1   # Command written to the radio's serial port
+TX = 2        # Radio packet about to be sent, before FourBySix encoding
+RX = 3        # Bytes read back from the radio's serial port
+
+NAMES = {
+  COMMAND: 'command',
+  TX: 'tx',
+  RX: 'rx'
+}
+
+# Record header: timestamp, kind, length of data
+_HEADER = struct.Struct('<dBH')
+
+_sink = None
+
+class LazyHex (object):
+  """
+  Formats data as hex, but only when the log record is actually emitted
+  """
+  __slots__ = ('data',)
+
+  def __init__ (self, data):
+    self.data = data
+
+  def __str__ (self):
+    return str(self.data).encode('hex')
+
+class LazyHexdump (LazyHex):
+  __slots__ = ()
+
+  def __str__ (self):
+    return hexdump(bytearray(self.data))
+
+class BinaryTraceSink (object):
+  """
+  Appends frames to a file as fixed-size headers followed by the raw bytes
+  """
+  def __init__ (self, path):
+    self.file = open(path, 'ab')
+
+  def write (self, kind, data):
+    data = str(data)
+    self.file.write(_HEADER.pack(time.time(), kind, len(data)) + data)
+
+  def close (self):
+    self.file.close()
+
+def set_sink (sink):
+  global _sink
+  _sink = sink
+
+def get_sink ():
+  return _sink
+
+def frame (logger, kind, data, level=logging.DEBUG, dump=False):
+  """
+  Record a frame to the binary sink if there is one, and to logger if it is
+  enabled for level. dump logs a full hexdump rather than a line of hex.
+  """
+  if _sink is not None:
+    _sink.write(kind, data)
+  if logger.isEnabledFor(level):
+    if dump:
+      logger.log(level, "%s: %s bytes\n%s", NAMES[kind], len(data), LazyHexdump(data))
+    else:
+      logger.log(level, "%s: %s", NAMES[kind], LazyHex(data))
+
+def read_trace (path):
+  """
+  Yields (timestamp, kind, data) for each frame recorded by BinaryTraceSink
+  """
+  with open(path, 'rb') as trace_file:
+    while True:
+      header = trace_file.read(_HEADER.size)
+      if len(header) < _HEADER.size:
+        return
+      stamp, kind, length = _HEADER.unpack(header)
+      yield stamp, kind, bytearray(trace_file.read(length))
@@ -0,0 +1,126 @@
+"""
+Event loop version of SerialRfSpy, for sharing one process between pump
+comms and other work without threads.
+
+Reads are driven by the loop watching the serial port's file descriptor,
+and complete 0x00-terminated responses are queued for get_response.
+do_command and do_commands hold a lock from sending until the response is
+in, so coroutines sharing the radio - a sniffer and a controller, say -
+take turns rather than getting each other's responses. Uses
+trollius, the asyncio port for Python 2 (pip install mmeowlink[async]).
+"""
+
+import logging
+
+import trollius as asyncio
+from trollius import From, Return
+
+from .. exceptions import CommsException
+from .. import trace
+
+from serial_rf_spy import SerialRfSpy
+
+io  = logging.getLogger( )
+log = io.getChild(__name__)
+
+class AsyncSerialRfSpy(SerialRfSpy):
+  def __init__(self, ser, loop=None):
+    SerialRfSpy.__init__(self, ser)
+    if self.fileno is None:
+      raise CommsException("The event loop transport needs a serial port with a file descriptor")
+
+    self.loop = loop or asyncio.get_event_loop()
+    self.responses = asyncio.Queue(loop=self.loop)
+    # Held by whichever coroutine has commands out
+    self.lock = asyncio.Lock(loop=self.loop)
+    # Reads only happen when the loop says there's input, so never block
+    self.ser.timeout = 0
+    self.loop.add_reader(self.fileno, self.data_received)
+
+  def close(self):
+    self.loop.remove_reader(self.fileno)
+
+  # Called by the loop whenever the port is readable
+  def data_received(self):
+    bytesToRead = self.ser.inWaiting()
+    if bytesToRead == 0:
+      return
+    chunk = self.ser.read(bytesToRead)
+    trace.frame(log, trace.RX, chunk)
+    self.buf.extend(chunk)
+
+    while True:
+      eop = self.buf.find(b'\x00', self.scanned)
+      if eop < 0:
+        self.scanned = len(self.buf)
+        return
+      r = self.buf[:eop]
+      del self.buf[:(eop+1)]
+      self.scanned = 0
+      if 0 < len(r) <= 2 and r[0] == self.RFSPY_ERROR_COMMAND_INTERRUPTED:
+        log.debug("response = command interrupted, getting the next response")
+        continue
+      self.responses.put_nowait(r)
+
+  # Only call with the lock held, or it may take someone else's response
+  def drop_stale(self):
+    # Anything still queued is a late answer to an earlier command
+    while not self.responses.empty():
+      stale = self.responses.get_nowait()
+      log.debug("Dropping stale response %s", trace.LazyHex(stale))
+
+  @asyncio.coroutine
+  def do_command(self, command, param="", timeout=0):
+    with (yield From(self.lock)):
+      self.drop_stale()
+      self.send_command(command, param, timeout=timeout)
+      if command == self.CMD_RESET:
+        self.radio_reset()
+        yield From(asyncio.sleep(1, loop=self.loop))
+      resp = yield From(self.get_response(timeout=timeout))
+    raise Return(resp)
+
+  @asyncio.coroutine
+  def do_commands(self, commands, timeout=0):
+    """
+    Send each (command, param) in commands back to back, then collect
+    their responses, in the same order
+    """
+    with (yield From(self.lock)):
+      self.drop_stale()
+      for command, param in commands:
+        self.send_command(command, param, timeout=timeout)
+      responses = [ ]
+      for command, param in commands:
+        resp = yield From(self.get_response(timeout=timeout))
+        responses.append(resp)
+    raise Return(responses)
+
+  @asyncio.coroutine
+  def get_response(self, timeout=None):
+    log.debug("get_response: timeout = %s", timeout)
+
+    if timeout is None or timeout <= 0:
+      # We don't want infinite hangs for things, as it'll lock up processing
+      raise CommsException("Timeout cannot be None, zero, or negative - coding error")
+
+    try:
+      resp = yield From(asyncio.wait_for(self.responses.get(), timeout, loop=self.loop))
+    except asyncio.TimeoutError:
+      log.debug("gave up waiting for response from subg_rfspy")
+      resp = bytearray()
+    raise Return(resp)
+
+  @asyncio.coroutine
+  def sync(self):
+    self.radio_reset()
+    status = yield From(self.do_command(self.CMD_GET_STATE, timeout=1))
+    if status == "OK":
+      log.info("subg_rfspy status: " + status)
+
+    version = yield From(self.do_command(self.CMD_GET_VERSION, timeout=1))
+    if len(version) >= 3:
+      log.info("Version: " + version)
+
+    if not status or not version:
+      raise CommsException("Could not get subg_rfspy state or version. Have you got the right port/device and radio_type?")
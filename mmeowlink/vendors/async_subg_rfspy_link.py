@@ -0,0 +1,106 @@
+"""
+Event loop version of SubgRfspyLink. The methods that talk to the radio
+are coroutines with the same arguments and results as the blocking ones:
+
+  link = AsyncSubgRfspyLink('/dev/ttyACM0', loop=loop)
+  data = yield From(link.write_and_read(buf))
+
+Opening the port and checking the firmware still happen synchronously, in
+the constructor, before the port is handed over to the loop.
+"""
+
+import logging
+import time
+
+import trollius as asyncio
+from trollius import From, Return
+
+from .. import trace
+
+from subg_rfspy_link import SubgRfspyLink
+from async_serial_rf_spy import AsyncSerialRfSpy
+
+io  = logging.getLogger( )
+log = io.getChild(__name__)
+
+class AsyncSubgRfspyLink(SubgRfspyLink):
+  def __init__(self, device, loop=None, max_symbol_corrections=0):
+    self.loop = loop or asyncio.get_event_loop()
+    SubgRfspyLink.__init__(self, device, max_symbol_corrections=max_symbol_corrections)
+
+  def check_setup(self):
+    SubgRfspyLink.check_setup(self)
+    self.serial_rf_spy = AsyncSerialRfSpy(self.serial, loop=self.loop)
+    self.serial_rf_spy.on_reset = self.forget_registers
+
+  def close(self):
+    self.serial_rf_spy.close()
+    return SubgRfspyLink.close(self)
+
+  @asyncio.coroutine
+  def update_register(self, reg, value, timeout=1):
+    yield From(self.update_registers([(reg, value)], timeout=timeout))
+
+  @asyncio.coroutine
+  def update_registers(self, registers, timeout=1):
+    rf_spy = self.serial_rf_spy
+    writes = self.register_writes_needed(registers)
+
+    responses = yield From(rf_spy.do_commands([ (rf_spy.CMD_UPDATE_REGISTER, chr(reg) + chr(value)) for reg, value in writes ], timeout=timeout))
+    for (reg, value), resp in zip(writes, responses):
+      self.register_written(reg, value, resp)
+
+  @asyncio.coroutine
+  def set_base_freq(self, freq_mhz):
+    yield From(self.update_registers(self.freq_registers(freq_mhz)))
+
+  @asyncio.coroutine
+  def write_and_read( self, string, repetitions=1, repetition_delay=0, timeout=None ):
+    rf_spy = self.serial_rf_spy
+
+    if timeout == None:
+      timeout = self.rtt.timeout()
+
+    timeout_ms = int(timeout * 1000)
+
+    trace.frame(log, trace.TX, string)
+
+    cmd_body = self.send_and_listen_body(string, repetitions, repetition_delay, timeout_ms)
+
+    start = time.time()
+    resp = yield From(rf_spy.do_command(rf_spy.CMD_SEND_AND_LISTEN, cmd_body, timeout=(timeout_ms/1000.0 + 1)))
+    raise Return(self.timed_response(resp, start, repetitions)['data'])
+
+  @asyncio.coroutine
+  def write( self, string, repetitions=1, repetition_delay=0, timeout=None ):
+    rf_spy = self.serial_rf_spy
+
+    if timeout is None:
+      timeout = self.timeout
+
+    trace.frame(log, trace.TX, string)
+
+    for message in self.send_packet_bodies(string, repetitions, repetition_delay):
+      yield From(rf_spy.do_command(rf_spy.CMD_SEND_PACKET, message, timeout=timeout))
+
+  @asyncio.coroutine
+  def get_packet( self, timeout=None ):
+    rf_spy = self.serial_rf_spy
+
+    if timeout is None:
+      timeout = self.timeout
+
+    timeout_ms = int(timeout * 1000)
+
+    cmd_body = self.get_packet_body(timeout_ms)
+
+    resp = yield From(rf_spy.do_command(rf_spy.CMD_GET_PACKET, cmd_body, timeout=timeout + 1))
+    raise Return(self.handle_response(resp))
+
+  @asyncio.coroutine
+  def read( self, timeout=None ):
+    if timeout is None:
+      timeout = self.timeout
+
+    packet = yield From(self.get_packet(timeout))
+    raise Return(packet['data'])
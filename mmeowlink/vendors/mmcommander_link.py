@@ -5,8 +5,9 @@ import array
 import logging
 import time
 
-from decocare.lib import hexdump
 from .. exceptions import InvalidPacketReceived, CommsException, MMCommanderNotWriteable
+from .. import trace
+from .. rtt import RttEstimator
 
 from serial_interface import SerialInterface
 
@@ -25,6 +26,10 @@ class MMCommanderLink(SerialInterface):
     self.device = device
     self.speed = 57600
     # radio_locale is not supported here
+    # Round trip times to the pump, and when the packet now awaiting a
+    # reply was sent
+    self.rtt = RttEstimator()
+    self.sent_at = None
 
     SerialInterface.__init__(self)
     self.open()
@@ -75,8 +80,8 @@ class MMCommanderLink(SerialInterface):
       if r != len(arr):
         raise CommsException("Could not write to serial port - Tried to write %s bytes but only wrote %s" % (len(arr), r))
 
-      io.info( 'usb.write.len: %s\n%s' % ( len( string ),
-                                           hexdump( bytearray( string ) ) ) )
+      trace.frame(io, trace.TX, message, level=logging.INFO, dump=True)
+      self.sent_at = time.time() if repetitions == 1 else None
 
       # If the batch is large, the hardware can take a while to respond to us.
       # Based on testing, this seems about right:
@@ -101,9 +106,12 @@ class MMCommanderLink(SerialInterface):
 
     return r
 
+  # A read straight after a write waits for as long as replies have been
+  # taking to come back, unless told otherwise. See RttEstimator
   def read( self, timeout=None ):
+    sent_at, self.sent_at = self.sent_at, None
     if timeout is None:
-      timeout = self.TIMEOUT
+      timeout = sent_at and self.rtt.timeout() or self.TIMEOUT
     self.serial.timeout = timeout
 
     # Result format:
@@ -121,6 +129,8 @@ class MMCommanderLink(SerialInterface):
     while True:
       state = self.serial.read(1)
       if (state is None) or len(state) == 0:
+        if sent_at:
+          self.rtt.timed_out()
         raise CommsException("No response from pump after timeout %s seconds" % timeout)
 
       if ord(state) == 2:
@@ -138,6 +148,9 @@ class MMCommanderLink(SerialInterface):
         if (message is None) or (len(message) == 0):
           raise CommsException("Timeout reading message body")
 
+        trace.frame(log, trace.RX, message)
+        if sent_at:
+          self.rtt.observe(time.time() - sent_at)
         return bytearray( message )
       else:
-        io.info( 'usb.read error: state message received. Ignoring value %i' % ord(state) )
+        io.info( 'usb.read error: state message received. Ignoring value %i', ord(state) )
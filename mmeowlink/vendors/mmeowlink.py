@@ -20,6 +20,8 @@ from dateutil.parser import parse
 
 from .. handlers.stick import Pump
 from .. link_builder import LinkBuilder
+from .. daemon import RemotePump
+from .. response_cache import ResponseCache
 
 def configure_use_app (app, parser):
   pass
@@ -36,6 +38,18 @@ def configure_app (app, parser):
     'port', default='scan',
     help='Radio serial port. e.g. /dev/ttyACM0 or /dev/ttyMFD1'
   )
+  parser.add_argument(
+    '--daemon', default=None,
+    help='Socket of a running mmeowlink-daemon.py to send commands through, instead of opening the radio'
+  )
+  parser.add_argument(
+    '--cache-reads', dest='cache_reads', action='store_true',
+    help='Answer reads of settings that hardly ever change, such as the model and basal profiles, from ~/.mmeowlink/responses.json while they are fresh'
+  )
+  parser.add_argument(
+    '--max-symbol-corrections', dest='max_symbol_corrections', type=int, default=0,
+    help='Try to correct up to this many corrupt symbols in each packet from a subg_rfspy radio, keeping the result only if its CRC checks out'
+  )
 
 def get_params(self, args):
   params = {key: args.__dict__.get(key) for key in (
@@ -68,12 +82,18 @@ def setup_medtronic_link (self):
   serial = self.device.get('serial')
   radio_type = self.device.get('radio_type')
   port = self.device.get('port')
+  daemon = self.device.get('daemon')
+  if daemon:
+    self.pump = RemotePump(serial, path=daemon)
+    return
+
   builder = LinkBuilder( )
   if port == 'scan':
-    port = builder.scan( )
+    port = builder.scan(radio_type)
 
-  link = builder.build(radio_type, port)
-  self.pump = Pump(link, serial)
+  link = builder.build(radio_type, port, max_symbol_corrections=int(self.device.get('max_symbol_corrections') or 0))
+  responses = ResponseCache( ) if self.device.get('cache_reads') == 'true' else None
+  self.pump = Pump(link, serial, responses=responses)
 
 
 @use( )
@@ -91,9 +111,14 @@ class mmtune (medtronic.MedtronicTask):
     # setup_logging(self)
     setup_medtronic_link(self)
     serial = self.device.get('serial')
-    self.mmtune = MMTune(self.pump.link, serial)
+    if isinstance(self.pump, RemotePump):
+      self.mmtune = None
+    else:
+      self.mmtune = MMTune(self.pump.link, serial)
 
   def main (self, args, app):
+    if self.mmtune is None:
+      return self.pump.mmtune(radio_locale='WW')
     return self.mmtune.run( )
 
 class MedtronicTask (medtronic.MedtronicTask):
@@ -126,6 +151,12 @@ def set_config (args, device):
   device.add_option('serial', args.serial)
   device.add_option('radio_type', args.radio_type)
   device.add_option('port', args.port)
+  if args.daemon:
+    device.add_option('daemon', args.daemon)
+  if args.cache_reads:
+    device.add_option('cache_reads', 'true')
+  if args.max_symbol_corrections:
+    device.add_option('max_symbol_corrections', args.max_symbol_corrections)
 
 def display_device (device):
   return ''
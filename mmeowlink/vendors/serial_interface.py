@@ -14,25 +14,39 @@ class AlreadyInUseException (Exception):
 
 class SerialInterface (object):
   serial = None
+  # Seconds to wait for another job to finish with the port before giving up
+  lock_timeout = 30
+  # Also look through /proc for processes that have the port open without
+  # locking it
+  check_open_files = True
+
   def open( self ):
     if not self.serial:
       log.info( '{agent} opening serial port'
         .format(agent=self.__class__.__name__ ))
 
-      if fuser.in_use(self.device):
-        raise AlreadyInUseException("%s already in use" % self.device)
-
       if self.device.find('spi') >= 0:
+        self.lock_port(None)
         import spi_serial
         self.serial = spi_serial.SpiSerial()
         self.check_setup()
       else:
-        self.serial = serial.Serial( self.device, self.speed )
+        port = serial.Serial( self.device, self.speed )
+        try:
+          self.lock_port(port.fileno())
+        except:
+          port.close()
+          raise
+        self.serial = port
         self.clear_receive_buffer('New port open')
         self.check_setup()
 
     return True
 
+  def lock_port( self, fd ):
+    if not fuser.lock(self.device, fd, timeout=self.lock_timeout, check_open_files=self.check_open_files):
+      raise AlreadyInUseException("%s already in use" % self.device)
+
   def close( self ):
     log.info( '{agent} stopped using serial port'
       .format(agent=self.__class__.__name__ ))
@@ -47,12 +61,12 @@ class SerialInterface (object):
     orig_timeout = self.serial.timeout
     self.serial.timeout = 0
     loops = 0
-    log.debug("clear_receive_buffer - %s - waiting for input" % message)
+    log.debug("clear_receive_buffer - %s - waiting for input", message)
     while True:
       resp = self.serial.read()
       if len(resp) == 0:
         self.serial.timeout = orig_timeout
-        log.debug("clear_receive_buffer - %s - looped %s times" % (message, loops))
+        log.debug("clear_receive_buffer - %s - looped %s times", message, loops)
         return
       loops = loops + 1
 
@@ -29,9 +29,11 @@
 
 
 import os
+import select
 import serial
 import time
 from .. exceptions import CommsException
+from .. import trace
 import logging
 
 io  = logging.getLogger( )
@@ -50,16 +52,33 @@ class SerialRfSpy:
   RFSPY_ERROR_COMMAND_INTERRUPTED = 0xbb
   RFSPY_ERROR_ZERO_DATA = 0xcc
 
+  # How often to check for input on ports we can't select() on, such as spi
+  POLL_INTERVAL = 0.005
+
   def __init__(self, ser):
     self.default_write_timeout = 1
     self.ser = ser
     self.buf = bytearray()
-
-  def do_command(self, command, param="", timeout=0):
+    # How far into buf we've already looked for the 0x00 terminator
+    self.scanned = 0
+    try:
+      self.fileno = ser.fileno()
+    except (AttributeError, ValueError, serial.SerialException):
+      self.fileno = None
+    # Called when the radio is reset or synced with, after which what it
+    # had been set to can't be relied on
+    self.on_reset = None
+
+  def radio_reset(self):
+    if self.on_reset is not None:
+      self.on_reset()
+
+  def do_command(self, command, param="", timeout=0, decoder=None):
     self.send_command(command, param, timeout=timeout)
     if command == self.CMD_RESET:
+	self.radio_reset()
 	time.sleep(1)
-    return self.get_response(timeout=timeout)
+    return self.get_response(timeout=timeout, decoder=decoder)
 
   def send_command(self, command, param="", timeout=1):
     if timeout is None or timeout <= 0:
@@ -71,42 +90,81 @@ class SerialRfSpy:
     cmd_str = chr(command) + param
 
     self.ser.write(cmd_str)
-    log.debug("command: " + cmd_str)
+    trace.frame(log, trace.COMMAND, cmd_str)
     #if len(param) > 0:
     #  log.debug("params: %s" % str(param).encode('hex'))
     #  self.ser.write(param)
 
     self.ser.write_timeout = self.default_write_timeout
 
-  def get_response(self, timeout=None):
-    log.debug("get_response: timeout = %s" % str(timeout))
+  # If a FourBySixDecoder is given, the radio packet following the RSSI and
+  # sequence bytes is fed to it as it arrives, rather than being decoded
+  # after the whole response has been read.
+  def get_response(self, timeout=None, decoder=None):
+    log.debug("get_response: timeout = %s", timeout)
 
     if timeout is None or timeout <= 0:
       # We don't want infinite hangs for things, as it'll lock up processing
       raise CommsException("Timeout cannot be None, zero, or negative - coding error")
 
-    start = time.time()
+    # How much of the pending response has been passed to the decoder
+    fed = 2
+    deadline = time.time() + timeout
     while 1:
-      bytesToRead = self.ser.inWaiting()
-      if bytesToRead > 0:
-        self.buf.extend(self.ser.read(bytesToRead))
-        log.debug("buf = %s" % str(self.buf).encode('hex'))
-      eop = self.buf.find(b'\x00',0)
+      eop = self.buf.find(b'\x00', self.scanned)
+      if eop < 0:
+        self.scanned = len(self.buf)
+      if decoder is not None:
+        end = eop if eop >= 0 else len(self.buf)
+        if end > fed:
+          decoder.feed(self.buf[fed:end])
+          fed = end
       if eop >= 0:
         r = self.buf[:eop]
         del self.buf[:(eop+1)]
+        self.scanned = 0
         if len(r) == 0:
           return bytearray()
         if len(r) <= 2 and r[0] == self.RFSPY_ERROR_COMMAND_INTERRUPTED:
           log.debug("response = command interrupted, getting the next response")
+          if decoder is not None:
+            decoder.reset()
+            fed = 2
           continue
         return r
-      if (start + timeout < time.time()):
+      remaining = deadline - time.time()
+      if remaining <= 0:
         log.debug("gave up waiting for response from subg_rfspy")
         return bytearray()
-      time.sleep(0.005)
+      self.read_available(remaining)
+
+  # Waits up to timeout for input to arrive, then reads all of it into buf.
+  # Wakes as soon as there's something to read, unless the port doesn't
+  # support select(), in which case it polls.
+  def read_available(self, timeout):
+    bytesToRead = self.ser.inWaiting()
+    if bytesToRead == 0:
+      if self.fileno is not None:
+        select.select([self.fileno], [], [], timeout)
+      else:
+        time.sleep(min(timeout, self.POLL_INTERVAL))
+      bytesToRead = self.ser.inWaiting()
+    if bytesToRead > 0:
+      chunk = self.ser.read(bytesToRead)
+      trace.frame(log, trace.RX, chunk)
+      self.buf.extend(chunk)
+
+  # Converts the RSSI byte at the start of a radio packet response to dBm
+  @staticmethod
+  def parse_rssi(rssi_dec):
+    rssi_offset = 73
+    if rssi_dec >= 128:
+      return (( rssi_dec - 256) / 2) - rssi_offset
+    else:
+      return (rssi_dec / 2) - rssi_offset
 
   def sync(self):
+    self.radio_reset()
     self.send_command(self.CMD_GET_STATE)
     status = self.get_response(timeout=1)
     if status == "OK":
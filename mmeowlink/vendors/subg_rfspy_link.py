@@ -8,11 +8,14 @@ import time
 
 from decocare.lib import hexdump, CRC8
 
-from .. fourbysix import FourBySix
+from .. fourbysix import FourBySix, FourBySixDecoder
 from .. exceptions import InvalidPacketReceived, CommsException, SubgRfspyVersionNotSupported
+from .. import trace
+from .. rtt import RttEstimator
 
 from serial_interface import SerialInterface
 from serial_rf_spy import SerialRfSpy
+from threaded_serial_rf_spy import ThreadedSerialRfSpy
 
 io  = logging.getLogger( )
 log = io.getChild(__name__)
@@ -40,33 +43,107 @@ class SubgRfspyLink(SerialInterface):
   UINT16_TIMEOUT_VERSIONS = ["0.6"]
   SUPPORTED_VERSIONS = ["0.6", "0.7", "0.8", "0.9"]
 
+  # subg_rfspy's response to CMD_UPDATE_REGISTER when the write succeeded
+  REGISTER_UPDATED = 1
+
   RFSPY_ERRORS = {
     0xaa: "Timeout",
     0xbb: "Command Interrupted",
     0xcc: "Zero Data"
   }
 
-  def __init__(self, device):
+  # max_symbol_corrections > 0 lets handle_response try to correct that many
+  # invalid FourBySix symbols in a packet, accepting the result only if its
+  # CRC8 checks out. See FourBySix.recover
+  #
+  # reader_thread hands reads from the port to a background thread once the
+  # firmware has been checked. See ThreadedSerialRfSpy
+  def __init__(self, device, max_symbol_corrections=0, reader_thread=False):
     self.timeout = 1
     self.device = device
     self.speed = 19200
     self.channel = 0
+    self.max_symbol_corrections = max_symbol_corrections
+    self.reader_thread = reader_thread
+    # Shadow of the radio's registers: the last value the firmware
+    # confirmed writing to each one
+    self.registers = { }
+    # Round trip times to the pump, for listen timeouts
+    self.rtt = RttEstimator()
 
     self.open()
 
   def update_register(self, reg, value, timeout=1):
-    args = chr(reg) + chr(value)
-    self.serial_rf_spy.do_command(self.serial_rf_spy.CMD_UPDATE_REGISTER, args, timeout=timeout)
+    self.update_registers([(reg, value)], timeout=timeout)
+
+  # Writes several registers, given as a dict or a sequence of (reg, value)
+  # pairs. Registers already holding the value are skipped, and the rest
+  # are sent back to back before any of the acks are collected.
+  def update_registers(self, registers, timeout=1):
+    rf_spy = self.serial_rf_spy
+    writes = self.register_writes_needed(registers)
+
+    for reg, value in writes:
+      rf_spy.send_command(rf_spy.CMD_UPDATE_REGISTER, chr(reg) + chr(value), timeout=timeout)
+    for reg, value in writes:
+      self.register_written(reg, value, rf_spy.get_response(timeout=timeout))
+
+  # The radio may have lost the registers written, so write them all again
+  # from now on
+  def forget_registers(self):
+    if self.registers:
+      log.debug("Forgetting %d register values", len(self.registers))
+    self.registers = { }
+
+  def register_writes_needed(self, registers):
+    if hasattr(registers, 'items'):
+      registers = registers.items()
+    return [ (reg, value) for reg, value in registers if self.registers.get(reg) != value ]
+
+  def register_written(self, reg, value, resp):
+    if resp and resp[0] == self.REGISTER_UPDATED:
+      self.registers[reg] = value
+    else:
+      # We don't know what the radio has now
+      self.registers.pop(reg, None)
+      log.debug("Register 0x%02x update not confirmed: %s", reg, trace.LazyHex(resp))
+
+  # The cached value of a register, or None if it hasn't been written
+  def get_register(self, reg):
+    return self.registers.get(reg)
+
+  def radio_config(self):
+    return dict(self.registers)
+
+  # The base frequency in MHz as last set, or None if it isn't known
+  def base_freq(self):
+    regs = [ self.get_register(reg) for reg in (self.REG_FREQ2, self.REG_FREQ1, self.REG_FREQ0) ]
+    if None in regs:
+      return None
+    val = (regs[0] << 16) | (regs[1] << 8) | regs[2]
+    return val * (self.FREQ_XTAL / float(2**16)) / 1000000
 
   def set_base_freq(self, freq_mhz):
+    self.update_registers(self.freq_registers(freq_mhz))
+
+  # Register values for a base frequency, in the order they're written
+  def freq_registers(self, freq_mhz):
     val = ((freq_mhz * 1000000)/(self.FREQ_XTAL/float(2**16)))
     val = long(val)
-    self.update_register(self.REG_FREQ0, val & 0xff)
-    self.update_register(self.REG_FREQ1, (val >> 8) & 0xff)
-    self.update_register(self.REG_FREQ2, (val >> 16) & 0xff)
+    return [
+      (self.REG_FREQ0, val & 0xff),
+      (self.REG_FREQ1, (val >> 8) & 0xff),
+      (self.REG_FREQ2, (val >> 16) & 0xff)
+    ]
 
   def check_setup(self):
+    self.forget_registers()
+    # Checking again, the reader thread has to give the port back first
+    rf_spy = getattr(self, 'serial_rf_spy', None)
+    if isinstance(rf_spy, ThreadedSerialRfSpy) and rf_spy.running:
+      rf_spy.stop()
     self.serial_rf_spy = SerialRfSpy(self.serial)
+    self.serial_rf_spy.on_reset = self.forget_registers
 #    if self.device.find('spi') >= 0:
 #        self.serial_rf_spy.do_command(SerialRfSpy.CMD_RESET, param="", timeout=1)
     self.serial_rf_spy.sync()
@@ -75,55 +152,66 @@ class SubgRfspyLink(SerialInterface):
     self.serial_rf_spy.send_command(self.serial_rf_spy.CMD_GET_VERSION, timeout=1)
     version = self.serial_rf_spy.get_response(timeout=1).split(' ')[1]
 
-    log.debug( 'serial_rf_spy Firmware version: %s' % version)
+    log.debug( 'serial_rf_spy Firmware version: %s', version)
 
     self.uint16_timeout_width = version in self.UINT16_TIMEOUT_VERSIONS
 
     if version not in self.SUPPORTED_VERSIONS:
       raise SubgRfspyVersionNotSupported("Your subg_rfspy version (%s) is not in the supported version list: %s" % (version, "".join(self.SUPPORTED_VERSIONS)))
 
-  def write_and_read( self, string, repetitions=1, repetition_delay=0, timeout=None ):
-    rf_spy = self.serial_rf_spy
-
-    if timeout == None:
-      timeout = 0.5
-
-    timeout_ms = int(timeout * 1000)
-
-
-    log.debug("write_and_read: %s" % str(string).encode('hex'))
+    if self.reader_thread:
+      self.serial_rf_spy = ThreadedSerialRfSpy(self.serial)
+      self.serial_rf_spy.on_reset = self.forget_registers
+
+  def close(self):
+    rf_spy = getattr(self, 'serial_rf_spy', None)
+    if isinstance(rf_spy, ThreadedSerialRfSpy) and rf_spy.running:
+      rf_spy.stop()
+    # The radio may be reconfigured by someone else while we're closed
+    self.forget_registers()
+    return SerialInterface.close(self)
+
+  def clear_receive_buffer(self, message):
+    # Once the reader thread is running it owns the port. It drops stale
+    # responses, and keeps unsolicited ones for take_unsolicited
+    rf_spy = getattr(self, 'serial_rf_spy', None)
+    if isinstance(rf_spy, ThreadedSerialRfSpy) and rf_spy.running:
+      rf_spy.clear_receive_buffer(message)
+      return
+    SerialInterface.clear_receive_buffer(self, message)
+
+  # The firmware's listen timeout, in milliseconds, in the width it expects
+  def encode_timeout(self, timeout_ms):
+    if self.uint16_timeout_width:
+      timeout_ms_high = int(timeout_ms / 256)
+      timeout_ms_low = int(timeout_ms - (timeout_ms_high * 256))
+      return chr(timeout_ms_high) + chr(timeout_ms_low)
+    else:
+      return chr(timeout_ms >> 24) + chr((timeout_ms >> 16) & 0xff) + \
+        chr((timeout_ms >> 8) & 0xff) + chr(timeout_ms & 0xff)
 
+  def send_and_listen_body(self, string, repetitions, repetition_delay, timeout_ms):
     if repetitions > self.MAX_REPETITION_BATCHSIZE:
       raise CommsException("repetition count of %d is greater than max repitition count of %d" % (repetitions, self.MAX_REPETITION_BATCHSIZE))
 
-    crc = CRC8.compute(string)
-
     listen_channel = self.channel
 
     cmd_body = chr(self.channel) + chr(repetitions - 1) + chr(repetition_delay) + chr(listen_channel)
-
-    if self.uint16_timeout_width:
-      timeout_ms_high = int(timeout_ms / 256)
-      timeout_ms_low = int(timeout_ms - (timeout_ms_high * 256))
-      cmd_body += chr(timeout_ms_high) + chr(timeout_ms_low)
-    else:
-      cmd_body += chr(timeout_ms >> 24) + chr((timeout_ms >> 16) & 0xff) + \
-        chr((timeout_ms >> 8) & 0xff) + chr(timeout_ms & 0xff)
+    cmd_body += self.encode_timeout(timeout_ms)
 
     retry_count = 0
     cmd_body += chr(retry_count)
 
     cmd_body += FourBySix.encode(string)
+    return cmd_body
 
-    resp = rf_spy.do_command(rf_spy.CMD_SEND_AND_LISTEN, cmd_body, timeout=(timeout_ms/1000.0 + 1))
-    return self.handle_response(resp)['data']
-
-  def write( self, string, repetitions=1, repetition_delay=0, timeout=None ):
-    rf_spy = self.serial_rf_spy
-
-    if timeout is None:
-      timeout = self.timeout
+  # Splits the repetitions into CMD_SEND_PACKET bodies of at most
+  # MAX_REPETITION_BATCHSIZE transmissions each
+  def send_packet_bodies(self, string, repetitions, repetition_delay):
+    # The frame is the same for every batch, so only encode it once
+    encoded = FourBySix.encode(string)
 
+    bodies = [ ]
     remaining_messages = repetitions
     while remaining_messages > 0:
       if remaining_messages < self.MAX_REPETITION_BATCHSIZE:
@@ -132,13 +220,58 @@ class SubgRfspyLink(SerialInterface):
         transmissions = self.MAX_REPETITION_BATCHSIZE
       remaining_messages = remaining_messages - transmissions
 
-      crc = CRC8.compute(string)
+      bodies.append(chr(self.channel) + chr(transmissions - 1) + chr(repetition_delay) + encoded)
+    return bodies
+
+  def get_packet_body(self, timeout_ms):
+    return chr(self.channel) + self.encode_timeout(timeout_ms)
+
+  # With no timeout given, listens for as long as replies have been taking
+  # to come back. See RttEstimator
+  def write_and_read( self, string, repetitions=1, repetition_delay=0, timeout=None ):
+    rf_spy = self.serial_rf_spy
+
+    if timeout == None:
+      timeout = self.rtt.timeout()
+
+    timeout_ms = int(timeout * 1000)
+
+    trace.frame(log, trace.TX, string)
+
+    cmd_body = self.send_and_listen_body(string, repetitions, repetition_delay, timeout_ms)
+
+    decoder = FourBySixDecoder()
+    start = time.time()
+    resp = rf_spy.do_command(rf_spy.CMD_SEND_AND_LISTEN, cmd_body, timeout=(timeout_ms/1000.0 + 1), decoder=decoder)
+    return self.timed_response(resp, start, repetitions, decoder=decoder)['data']
 
-      message = chr(self.channel) + chr(transmissions - 1) + chr(repetition_delay) + FourBySix.encode(string)
+  # handle_response, feeding the round trip time of single packet
+  # exchanges to the estimator
+  def timed_response( self, resp, start, repetitions=1, decoder=None ):
+    try:
+      result = self.handle_response(resp, decoder=decoder)
+    except CommsException:
+      if repetitions == 1:
+        self.rtt.timed_out()
+      raise
+    if repetitions == 1:
+      self.rtt.observe(time.time() - start)
+    return result
 
+  def write( self, string, repetitions=1, repetition_delay=0, timeout=None ):
+    rf_spy = self.serial_rf_spy
+
+    if timeout is None:
+      timeout = self.timeout
+
+    trace.frame(log, trace.TX, string)
+
+    for message in self.send_packet_bodies(string, repetitions, repetition_delay):
       rf_spy.do_command(rf_spy.CMD_SEND_PACKET, message, timeout=timeout)
 
-  def handle_response( self, resp ):
+  # decoder, if given, has already been fed the packet by get_response. A
+  # response framed by the reader thread carries its own.
+  def handle_response( self, resp, decoder=None ):
     if not resp:
       raise CommsException("Did not get a response, or response is too short: %s" % len(resp))
 
@@ -151,14 +284,21 @@ class SubgRfspyLink(SerialInterface):
     if len(resp) <= 2:
       raise CommsException("Received an error response %s" % self.RFSPY_ERRORS[ resp[0] ])
 
-    decoded = FourBySix.decode(resp[2:])
+    decoder = getattr(resp, 'decoder', None) or decoder
+    try:
+      if decoder is not None:
+        decoded = decoder.finish()
+      else:
+        decoded = FourBySix.decode(resp[2:])
+    except InvalidPacketReceived as e:
+      if not self.max_symbol_corrections:
+        raise
+      log.debug("Trying to correct FourBySix packet: %s", e)
+      decoded = FourBySix.recover(resp[2:], max_errors=self.max_symbol_corrections)
 
-    rssi_dec = resp[0]
-    rssi_offset = 73
-    if rssi_dec >= 128:
-      rssi = (( rssi_dec - 256) / 2) - rssi_offset
-    else:
-      rssi = (rssi_dec / 2) - rssi_offset
+    rssi = getattr(resp, 'rssi', None)
+    if rssi is None:
+      rssi = SerialRfSpy.parse_rssi(resp[0])
 
     sequence = resp[1]
 
@@ -172,17 +312,11 @@ class SubgRfspyLink(SerialInterface):
 
     timeout_ms = int(timeout * 1000)
 
-    cmd_body = chr(self.channel)
-    if self.uint16_timeout_width:
-      timeout_ms_high = int(timeout_ms / 256)
-      timeout_ms_low = int(timeout_ms - (timeout_ms_high * 256))
-      cmd_body += chr(timeout_ms_high) + chr(timeout_ms_low)
-    else:
-      cmd_body += chr(timeout_ms >> 24) + chr((timeout_ms >> 16) & 0xff) + \
-        chr((timeout_ms >> 8) & 0xff) + chr(timeout_ms & 0xff)
+    cmd_body = self.get_packet_body(timeout_ms)
 
-    resp = rf_spy.do_command(SerialRfSpy.CMD_GET_PACKET, cmd_body, timeout=timeout + 1)
-    return self.handle_response(resp)
+    decoder = FourBySixDecoder()
+    resp = rf_spy.do_command(SerialRfSpy.CMD_GET_PACKET, cmd_body, timeout=timeout + 1, decoder=decoder)
+    return self.handle_response(resp, decoder=decoder)
 
   def read( self, timeout=None ):
     if timeout is None:
@@ -0,0 +1,201 @@
+"""
+SerialRfSpy with a dedicated thread that owns reads from the serial port.
+
+The thread splits the byte stream into 0x00-terminated responses, drops
+"command interrupted" frames, and for radio packets parses the RSSI and
+sequence and FourBySix-decodes the packet, before queueing the response
+for get_response. That work then overlaps with the next transfer.
+
+Responses are matched to commands in the order they were sent. One that
+arrives with no command waiting for it - a packet heard between
+commands, or the late answer to a command that timed out - is
+unsolicited. It's kept apart from the responses, on a bounded queue that
+take_unsolicited empties, and passed to on_unsolicited if that's set. A
+response left queued after its command gave up waiting is stale, and
+clear_receive_buffer drops it before the next command goes out.
+"""
+
+import collections
+import logging
+import Queue
+import threading
+
+import serial
+
+from .. fourbysix import FourBySixDecoder
+from .. exceptions import CommsException
+from .. import trace
+
+from serial_rf_spy import SerialRfSpy
+
+io  = logging.getLogger( )
+log = io.getChild(__name__)
+
+class RfSpyResponse(bytearray):
+  """
+  A response as framed by the reader thread. For radio packets, rssi and
+  sequence are filled in, and decoder has already been fed the packet.
+  """
+  rssi = None
+  sequence = None
+  decoder = None
+
+class ThreadedSerialRfSpy(SerialRfSpy):
+  # Responses kept for get_response, and unsolicited ones kept for
+  # take_unsolicited. When full, the oldest is dropped
+  QUEUE_SIZE = 16
+  UNSOLICITED_SIZE = 16
+  # How long the reader blocks in each read, which bounds how long stop() takes
+  READ_TIMEOUT = 0.1
+
+  PACKET_COMMANDS = (SerialRfSpy.CMD_GET_PACKET, SerialRfSpy.CMD_SEND_AND_LISTEN)
+
+  # on_unsolicited, if given, is called from the reader thread with each
+  # unsolicited response
+  def __init__(self, ser, on_unsolicited=None):
+    SerialRfSpy.__init__(self, ser)
+    self.responses = Queue.Queue(maxsize=self.QUEUE_SIZE)
+    self.unsolicited = collections.deque(maxlen=self.UNSOLICITED_SIZE)
+    self.on_unsolicited = on_unsolicited
+    # For each command sent but not yet answered through get_response, in
+    # order, whether its response will be a radio packet
+    self.pending = collections.deque()
+    self.lock = threading.Lock()
+    self.running = True
+
+    self.ser.timeout = self.READ_TIMEOUT
+    self.thread = threading.Thread(target=self.run, name='subg_rfspy reader')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    self.thread.join()
+
+  def run(self):
+    while self.running:
+      try:
+        chunk = self.ser.read(max(self.ser.inWaiting(), 1))
+      except (serial.SerialException, OSError, TypeError) as e:
+        # pyserial raises TypeError for a port closed under the read
+        log.error("subg_rfspy reader stopping - %s", e)
+        self.running = False
+        return
+      if not chunk:
+        continue
+      trace.frame(log, trace.RX, chunk)
+      self.buf.extend(chunk)
+
+      while True:
+        eop = self.buf.find(b'\x00', self.scanned)
+        if eop < 0:
+          self.scanned = len(self.buf)
+          break
+        r = self.buf[:eop]
+        del self.buf[:(eop+1)]
+        self.scanned = 0
+        self.received(r)
+
+  def received(self, r):
+    if 0 < len(r) <= 2 and r[0] == self.RFSPY_ERROR_COMMAND_INTERRUPTED:
+      log.debug("response = command interrupted, getting the next response")
+      return
+
+    resp = RfSpyResponse(r)
+    # A guess at which command this answers, so the packet can be decoded
+    # here. get_response checks it
+    with self.lock:
+      index = self.responses.qsize()
+      solicited = index < len(self.pending)
+      expect_packet = solicited and self.pending[index]
+    if not solicited:
+      self.received_unsolicited(resp)
+      return
+    if expect_packet:
+      self.parse_packet(resp)
+
+    while True:
+      try:
+        self.responses.put_nowait(resp)
+        return
+      except Queue.Full:
+        try:
+          dropped = self.responses.get_nowait()
+          log.debug("Response queue full, dropping %s", trace.LazyHex(dropped))
+        except Queue.Empty:
+          pass
+
+  # What arrives unasked is usually a radio packet, so it's decoded as one
+  def received_unsolicited(self, resp):
+    log.debug("Unsolicited response %s", trace.LazyHex(resp))
+    self.parse_packet(resp)
+    with self.lock:
+      self.unsolicited.append(resp)
+    if self.on_unsolicited is not None:
+      try:
+        self.on_unsolicited(resp)
+      except Exception as e:
+        log.error("on_unsolicited failed - %s", e)
+
+  def take_unsolicited(self):
+    """
+    The unsolicited responses received since the last call, oldest first
+    """
+    with self.lock:
+      taken = list(self.unsolicited)
+      self.unsolicited.clear()
+    return taken
+
+  def clear_receive_buffer(self, message):
+    """
+    Drop responses still queued for commands that have given up on them,
+    if no command is waiting. Unsolicited responses are kept
+    """
+    with self.lock:
+      if self.pending:
+        return
+      while True:
+        try:
+          stale = self.responses.get_nowait()
+        except Queue.Empty:
+          return
+        log.debug("clear_receive_buffer - %s - dropping stale response %s", message, trace.LazyHex(stale))
+
+  def parse_packet(self, resp):
+    if len(resp) > 2:
+      resp.rssi = self.parse_rssi(resp[0])
+      resp.sequence = resp[1]
+      resp.decoder = FourBySixDecoder()
+      resp.decoder.feed(resp[2:])
+
+  def send_command(self, command, param="", timeout=1):
+    self.clear_receive_buffer('Sending command')
+    with self.lock:
+      self.pending.append(command in self.PACKET_COMMANDS)
+    SerialRfSpy.send_command(self, command, param, timeout=timeout)
+
+  # The reader thread does the decoding, so decoder is ignored here; the
+  # decoder it used is attached to the response instead
+  def get_response(self, timeout=None, decoder=None):
+    log.debug("get_response: timeout = %s", timeout)
+
+    if timeout is None or timeout <= 0:
+      # We don't want infinite hangs for things, as it'll lock up processing
+      raise CommsException("Timeout cannot be None, zero, or negative - coding error")
+
+    try:
+      resp = self.responses.get(timeout=timeout)
+    except Queue.Empty:
+      log.debug("gave up waiting for response from subg_rfspy")
+      resp = None
+
+    # This answers, or gives up on, the oldest command still unanswered
+    with self.lock:
+      expect_packet = self.pending.popleft() if self.pending else False
+    if resp is None:
+      return bytearray()
+    if expect_packet and resp.decoder is None:
+      self.parse_packet(resp)
+    elif not expect_packet and resp.decoder is not None:
+      resp = RfSpyResponse(resp)
+    return resp
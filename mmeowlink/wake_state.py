@@ -0,0 +1,50 @@
+"""
+Remembers, across runs, until when each pump was woken, so a wakeup that's
+still running isn't repeated. Kept per pump serial and radio port in
+~/.mmeowlink/awake.json. See Pump.power_control
+"""
+
+import time
+
+from cache import cache_path, load_json, locked, save_json
+
+class WakeState (object):
+  FILE = 'awake.json'
+  # Treat sessions this close to running out as over
+  MARGIN = 30
+
+  def __init__ (self, path=None, margin=MARGIN):
+    self.path = path or cache_path(self.FILE)
+    self.margin = margin
+
+  @staticmethod
+  def key (serial, radio):
+    return '%s@%s' % (serial, radio)
+
+  def expiry (self, serial, radio):
+    """
+    When the pump's wakeup over radio runs out, or None if it isn't known
+    """
+    return load_json(self.path, { }).get(self.key(serial, radio))
+
+  def awake (self, serial, radio, now=None):
+    expiry = self.expiry(serial, radio)
+    return expiry is not None and (now or time.time()) + self.margin < expiry
+
+  def update (self, serial, radio, expiry):
+    now = time.time()
+    with locked(self.path):
+      state = load_json(self.path, { })
+      # Drop sessions that are long over
+      state = dict((key, value) for key, value in state.items() if value > now)
+      if expiry is None:
+        state.pop(self.key(serial, radio), None)
+      else:
+        state[self.key(serial, radio)] = expiry
+      save_json(self.path, state)
+
+  def record (self, serial, radio, minutes):
+    self.update(serial, radio, time.time() + minutes * 60)
+
+  def forget (self, serial, radio):
+    self.update(serial, radio, None)
@@ -17,9 +17,13 @@ setup(
       'python-dateutil',
       'pyserial'
     ],
+    extras_require={
+      'async': ['trollius']
+    },
     scripts = [
       'bin/mmeowlink-bolus.py',
       'bin/mmeowlink-any-pump-comms.py',
+      'bin/mmeowlink-daemon.py',
       'bin/mmeowlink-rf-dump.py',
       'bin/mmeowlink-send.py',
       'bin/mmtune.py'
@@ -0,0 +1,55 @@
+import unittest
+
+from decocare import commands
+
+from mmeowlink.emulator import PumpEmulator, SubgRfspyEmulator
+from mmeowlink.handlers.stick import Pump, Sender
+from mmeowlink.rtt import RttEstimator
+from mmeowlink.vendors.subg_rfspy_link import SubgRfspyLink
+
+class TestRttEstimator (unittest.TestCase):
+  def test_backs_off_from_the_floor (self):
+    rtt = RttEstimator( )
+    for n in range(10):
+      rtt.observe(0.005)
+    self.assertEqual(rtt.timeout( ), rtt.FLOOR)
+    rtt.timed_out( )
+    self.assertEqual(rtt.timeout( ), 2 * rtt.FLOOR)
+
+  def test_slow_reply_after_fast_ones_within_retries (self):
+    rtt = RttEstimator( )
+    for n in range(10):
+      rtt.observe(0.005)
+    timeouts = [ ]
+    for attempt in range(Sender.STANDARD_RETRY_COUNT):
+      timeouts.append(rtt.timeout( ))
+      rtt.timed_out( )
+    self.assertTrue(max(timeouts) >= 0.15, timeouts)
+
+  def test_ceiling (self):
+    rtt = RttEstimator( )
+    for n in range(10):
+      rtt.timed_out( )
+    self.assertEqual(rtt.timeout( ), rtt.CEILING)
+
+class TestSlowPump (unittest.TestCase):
+  def setUp (self):
+    self.emulator = SubgRfspyEmulator(PumpEmulator(awake=True))
+    self.emulator.start( )
+    self.link = SubgRfspyLink(self.emulator.port)
+    self.pump = Pump(self.link, self.emulator.pump.serial)
+
+  def tearDown (self):
+    self.link.close( )
+    self.emulator.stop( )
+
+  def test_slow_reply_after_fast_ones (self):
+    for n in range(10):
+      self.assertIsNotNone(self.pump.execute(commands.ReadPumpModel( )))
+    self.emulator.reply_latency = 0.15
+    command = commands.TempBasal(params=[ 0, 0x14, 1 ])
+    self.assertIsNotNone(self.pump.execute(command))
+    self.assertTrue(command.timing.retries < Sender.STANDARD_RETRY_COUNT)
+
+if __name__ == '__main__':
+  unittest.main( )